@@ -0,0 +1,121 @@
+from datetime import date, timedelta
+from windows import SERVER_USER_ID, WINDOWS
+
+# Счётчики пары (модератор, пользователь): [выдано LP, снято LP, изменений]
+GIVEN, REMOVED, CHANGES = range(3)
+
+def count_entry(pairs, entry, sign=1):
+    """Учесть запись истории в {changer_id: {target_id: счётчики}} (sign=-1 - отменить).
+    Итоговые записи обо всём сервере (затухание) - не действия модераторов"""
+    target_id = str(entry['target_id'])
+    if target_id == str(SERVER_USER_ID):
+        return
+    changer_id = str(entry['changer_id'])
+    targets = pairs.setdefault(changer_id, {})
+    counters = targets.get(target_id)
+    if counters is None:
+        counters = targets[target_id] = [0, 0, 0]
+    amount = entry['amount']
+    if amount > 0:
+        counters[GIVEN] += sign * amount
+    else:
+        counters[REMOVED] -= sign * amount
+    counters[CHANGES] += sign
+    if not counters[CHANGES]:
+        del targets[target_id]
+        if not targets:
+            del pairs[changer_id]
+
+def merge_pairs(into, pairs):
+    for changer_id, targets in pairs.items():
+        merged = into.setdefault(changer_id, {})
+        for target_id, counters in targets.items():
+            current = merged.get(target_id)
+            if current is None:
+                merged[target_id] = list(counters)
+            else:
+                for i, value in enumerate(counters):
+                    current[i] += value
+    return into
+
+def copy_pairs(pairs):
+    return {changer_id: {target_id: list(counters) for target_id, counters in targets.items()}
+            for changer_id, targets in pairs.items()}
+
+def summarize_moderators(pairs):
+    """[(changer_id, выдано, снято, изменений, пользователей)], самые активные первыми"""
+    rows = []
+    for changer_id, targets in pairs.items():
+        given = sum(counters[GIVEN] for counters in targets.values())
+        removed = sum(counters[REMOVED] for counters in targets.values())
+        changes = sum(counters[CHANGES] for counters in targets.values())
+        rows.append((changer_id, given, removed, changes, len(targets)))
+    rows.sort(key=lambda row: (-row[3], -(row[1] + row[2]), row[0]))
+    return rows
+
+def summarize_targets(pairs, changer_id):
+    """[(target_id, выдано, снято, изменений)] модератора, по объёму изменений"""
+    rows = [(target_id, *counters) for target_id, counters in pairs.get(str(changer_id), {}).items()]
+    rows.sort(key=lambda row: (-(row[1] + row[2]), -row[3], row[0]))
+    return rows
+
+class AuditAggregates:
+    """Кто из модераторов сколько LP выдал и снял, кому и сколько раз.
+
+    totals - за всё время, days - по дням за самое длинное окно из windows.py
+    (для сводок за день, неделю и месяц). Обновляется при каждой записи
+    истории, поэтому сводка не требует просмотра журнала. Ключи - id
+    строками, как в счётчиках сегментов истории."""
+    def __init__(self, windows=WINDOWS):
+        self.windows = dict(windows)
+        self.totals = {}
+        self.days = {}
+    
+    def _cutoff(self, days):
+        return (date.today() - timedelta(days=days - 1)).isoformat()
+    
+    def first_day(self):
+        return self._cutoff(max(self.windows.values()))
+    
+    def _expire(self):
+        first_day = self.first_day()
+        for day in [day for day in self.days if day < first_day]:
+            del self.days[day]
+    
+    def add_day(self, entry, sign=1):
+        """Учесть запись только в сводках по дням (итоги за всё время уже посчитаны)"""
+        day = entry['timestamp'][:10]
+        if day < self.first_day():
+            return
+        pairs = self.days.setdefault(day, {})
+        count_entry(pairs, entry, sign)
+        if not pairs:
+            del self.days[day]
+    
+    def add(self, entry, sign=1):
+        count_entry(self.totals, entry, sign)
+        self.add_day(entry, sign)
+    
+    def discard(self, entry):
+        self.add(entry, sign=-1)
+    
+    def period(self, window=None):
+        """Копия сводки {changer_id: {target_id: счётчики}} за окно (day, week, month)
+        или за всё время"""
+        if window is None:
+            return copy_pairs(self.totals)
+        self._expire()
+        cutoff = self._cutoff(self.windows[window])
+        result = {}
+        for day, pairs in list(self.days.items()):
+            if day >= cutoff:
+                merge_pairs(result, pairs)
+        return result
+    
+    def snapshot(self):
+        """Сводки по дням для сохранения"""
+        return {day: copy_pairs(pairs) for day, pairs in self.days.items()}
+    
+    def load(self, days):
+        first_day = self.first_day()
+        self.days = {day: copy_pairs(pairs) for day, pairs in days.items() if day >= first_day}
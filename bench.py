@@ -0,0 +1,341 @@
+"""Офлайн-бенчмарки RatingDatabase и команд бота (без подключения к Discord).
+
+Примеры:
+    python bench.py --users 10000 100000 --history 100000
+    python bench.py --storage json sqlite --output bench_new.json --compare bench_old.json
+
+Для каждого сценария печатается пропускная способность, p50/p99 задержки
+и пиковая память (tracemalloc), результаты сохраняются в JSON для сравнения
+запусков. Команды main.py вызываются напрямую с поддельными ctx/bot, у которых
+fetch_user отвечает с задержкой --fetch-latency."""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from database import RatingDatabase
+from sqlite_storage import SqliteStorage
+
+def open_db(storage, data_dir):
+    if storage == 'sqlite':
+        return RatingDatabase(storage=SqliteStorage(os.path.join(data_dir, 'ratings.sqlite3')))
+    return RatingDatabase(data_dir=data_dir, journal=True)
+
+def populate(db, users, history, months=12):
+    """Заполнить базу одной транзакцией: users рейтингов и history записей за months месяцев"""
+    start = datetime.now() - timedelta(days=30 * months)
+    step = timedelta(days=30 * months) / max(history, 1)
+    moderators = [str(10 ** 17 + i) for i in range(20)]
+    with db.transaction() as tx:
+        for user_id in range(users):
+            tx.ratings[str(10 ** 18 + user_id)] = random.randint(-500, 5000)
+        for i in range(history):
+            tx.history.append({
+                'timestamp': (start + step * i).isoformat(),
+                'changer_id': random.choice(moderators),
+                'target_id': str(10 ** 18 + random.randrange(users)),
+                'amount': random.randint(-20, 20),
+                'comment': random.choice((None, 'За ивент', 'Штраф'))
+            })
+
+def random_user(users):
+    return 10 ** 18 + random.randrange(users)
+
+def summarize(name, params, latencies, elapsed, peak):
+    latencies = sorted(latencies)
+    return {
+        'name': name,
+        'params': params,
+        'ops': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'peak_mb': peak / 2 ** 20
+    }
+
+def measure(name, params, fn, iterations, memory=True):
+    if memory:
+        tracemalloc.start()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(name, params, latencies, elapsed, peak)
+
+async def ameasure(name, params, fn, iterations, memory=True):
+    if memory:
+        tracemalloc.start()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        await fn()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(name, params, latencies, elapsed, peak)
+
+def bench_database(args, storage, users, workdir):
+    """Сценарии RatingDatabase: загрузка/сохранение, изменения, топ и история"""
+    results = []
+    params = {'storage': storage, 'users': users, 'history': args.history}
+    data_dir = os.path.join(workdir, f'db-{storage}-{users}')
+    db = open_db(storage, data_dir)
+    populate(db, users, args.history)
+    db.close()
+    
+    holder = {}
+    def load():
+        holder['db'] = open_db(storage, data_dir)
+        holder['db'].close()
+    results.append(measure('db.load', params, load, args.repeat, args.memory))
+    
+    db = open_db(storage, data_dir)
+    if storage == 'json':
+        results.append(measure('db.save', params, lambda: db.storage.compact(), args.repeat, args.memory))
+    
+    moderator = 10 ** 17
+    results.append(measure('db.add_rating', params,
+                           lambda: db.add_rating(random_user(users), 5, changer_id=moderator, comment='bench'),
+                           args.ops, args.memory))
+    results.append(measure('db.remove_rating', params,
+                           lambda: db.remove_rating(random_user(users), 5, changer_id=moderator),
+                           args.ops, args.memory))
+    
+    def batch():
+        with db.transaction() as tx:
+            for _ in range(10):
+                tx.add_rating(random_user(users), 1, changer_id=moderator)
+    results.append(measure('db.transaction[10]', params, batch, args.ops, args.memory))
+    
+    queries = [
+        ('db.get_rating_history', lambda: db.get_rating_history(random_user(users), limit=5)),
+        ('db.get_rating_history[page]', lambda: db.get_rating_history(random_user(users), limit=10, offset=10)),
+        ('db.get_changes_by', lambda: db.get_changes_by(10 ** 17 + random.randrange(20), limit=10)),
+        ('db.get_recent_history', lambda: db.get_recent_history(10)),
+        ('db.get_top_users', lambda: db.get_top_users(10)),
+        ('db.get_bottom_users', lambda: db.get_bottom_users(10)),
+        ('db.get_users_page', lambda: db.get_users_page(random.randrange(users), 10)),
+        ('db.get_user_rank', lambda: db.get_user_rank(random_user(users))),
+        ('db.get_window_leaderboard', lambda: db.get_window_leaderboard('week').page(0, 10))
+    ]
+    for name, fn in queries:
+        results.append(measure(name, params, fn, args.ops, args.memory))
+    db.close()
+    return results
+
+class FakeAsset:
+    url = 'https://cdn.discordapp.com/embed/avatars/0.png'
+
+class FakeUser:
+    def __init__(self, user_id, roles=()):
+        self.id = user_id
+        self.display_name = f'user{user_id}'
+        self.mention = f'<@{user_id}>'
+        self.avatar = None
+        self.default_avatar = FakeAsset()
+        self.roles = list(roles)
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+    
+    def get_member(self, user_id):
+        # Кэш участников пуст: имена идут через кэш резолвера или fetch_user
+        return None
+    
+    def get_role(self, role_id):
+        return None
+
+class FakeBot:
+    """Заменитель бота: fetch_user отвечает с задержкой, как REST API"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.fetches = 0
+    
+    def get_user(self, user_id):
+        return None
+    
+    async def fetch_user(self, user_id):
+        self.fetches += 1
+        await asyncio.sleep(self.latency)
+        return FakeUser(user_id)
+
+class FakeMessage:
+    def __init__(self, content, mentions):
+        self.content = content
+        self.mentions = mentions
+        self.role_mentions = []
+
+class FakeContext:
+    def __init__(self, bot, guild, author, content='', mentions=(), invoked_with=''):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.prefix = '!'
+        self.invoked_with = invoked_with
+        self.message = FakeMessage(content, list(mentions))
+        self.sent = 0
+    
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+    
+    async def edit_message(self, **kwargs):
+        self.done = True
+    
+    async def defer(self):
+        self.done = True
+    
+    def is_done(self):
+        return self.done
+
+class FakeInteraction:
+    def __init__(self):
+        self.response = FakeResponse()
+        self.edits = 0
+    
+    async def edit_original_response(self, **kwargs):
+        self.edits += 1
+
+async def bench_commands(args, storage, users, workdir):
+    """Команды main.py с поддельными ctx/bot"""
+    try:
+        import main
+    except ImportError as e:
+        print(f"Команды пропущены: {e}")
+        return []
+    from names import NameResolver
+    from shards import GuildShards, open_guild_db
+    
+    os.environ['RATING_STORAGE'] = storage
+    params = {'storage': storage, 'users': users, 'history': args.history,
+              'fetch_latency_ms': args.fetch_latency * 1000}
+    root = os.path.join(workdir, f'cmd-{storage}-{users}')
+    guild = FakeGuild(1)
+    main.shards = GuildShards(root, open_guild_db)
+    populate(main.shards.get(guild.id), users, args.history)
+    
+    fake_bot = FakeBot(args.fetch_latency)
+    main.names = NameResolver(fake_bot)
+    main.top_page_cache = main.PageCache()
+    moderator = FakeUser(10 ** 17)
+    results = []
+    
+    async def add_one():
+        member = FakeUser(random_user(users))
+        ctx = FakeContext(fake_bot, guild, moderator, f'!добавить 5 {member.mention} bench',
+                          [member], 'добавить')
+        await main.add_rating.callback(ctx, 5, [member])
+    results.append(await ameasure('cmd.add_rating', params, add_one, args.ops, args.memory))
+    
+    async def add_many():
+        members = [FakeUser(random_user(users)) for _ in range(10)]
+        content = '!добавить 5 ' + ' '.join(member.mention for member in members) + ' bench'
+        ctx = FakeContext(fake_bot, guild, moderator, content, members, 'добавить')
+        await main.add_rating.callback(ctx, 5, members)
+    results.append(await ameasure('cmd.add_rating[10]', params, add_many, args.ops, args.memory))
+    
+    async def show_rating():
+        ctx = FakeContext(fake_bot, guild, moderator)
+        await main.show_rating.callback(ctx, FakeUser(random_user(users)))
+    results.append(await ameasure('cmd.show_rating', params, show_rating, args.command_ops, args.memory))
+    
+    async def show_top():
+        ctx = FakeContext(fake_bot, guild, moderator)
+        await main.show_top.callback(ctx, None, 10, random.randint(1, 50))
+    results.append(await ameasure('cmd.show_top', params, show_top, args.command_ops, args.memory))
+    
+    view = main.TopPaginationView(fake_bot, main.shards.get(guild.id).leaderboard,
+                                  10, guild=guild)
+    async def page_flip():
+        await view.next_button.callback(FakeInteraction())
+    results.append(await ameasure('view.page_flip', params, page_flip, args.command_ops, args.memory))
+    
+    main.shards.close()
+    for result in results:
+        result['fetch_user_calls'] = fake_bot.fetches
+    return results
+
+def compare(results, previous_path):
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+    print(f"\nСравнение с {previous_path}:")
+    for result in results:
+        old = previous.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if old is None:
+            continue
+        ratio = old['p50_ms'] / result['p50_ms'] if result['p50_ms'] else float('inf')
+        print(f"  {result['name']:<30} {result['params']}: p50 {old['p50_ms']:.3f} → "
+              f"{result['p50_ms']:.3f} мс (x{ratio:.2f})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки рейтинга")
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--history', type=int, default=100000)
+    parser.add_argument('--storage', nargs='+', choices=['json', 'sqlite'], default=['json'])
+    parser.add_argument('--ops', type=int, default=500, help="повторов для быстрых операций")
+    parser.add_argument('--command-ops', type=int, default=50, help="повторов для команд с сетью")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов загрузки/сохранения")
+    parser.add_argument('--fetch-latency', type=float, default=0.05, help="задержка fetch_user, с")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="не измерять память (tracemalloc замедляет код)")
+    parser.add_argument('--no-commands', dest='commands', action='store_false')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="JSON предыдущего запуска для сравнения")
+    args = parser.parse_args(argv)
+    
+    workdir = tempfile.mkdtemp(prefix='rating-bench-')
+    results = []
+    try:
+        for storage in args.storage:
+            for users in args.users:
+                results.extend(bench_database(args, storage, users, workdir))
+                if args.commands:
+                    results.extend(asyncio.run(bench_commands(args, storage, users, workdir)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    for result in results:
+        print(f"{result['name']:<30} {result['params']['storage']:<6} users={result['params']['users']:<8} "
+              f"{result['throughput']:>10.1f} оп/с  p50 {result['p50_ms']:>9.3f} мс  "
+              f"p99 {result['p99_ms']:>9.3f} мс  память {result['peak_mb']:>8.1f} МБ")
+    
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'args': vars(args)
+        },
+        'results': results
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
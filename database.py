@@ -1,112 +1,208 @@
-import json
-import os
 from datetime import datetime
+from metrics import metrics
+from storage import JsonStorage
 
-class RatingDatabase:
-    def __init__(self, filename='ratings.json', history_filename='history.json'):
-        self.filename = filename
-        self.history_filename = history_filename
-        data_dir = '/data'
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-        self.filename = os.path.join(data_dir, filename)
-        self.history_filename = os.path.join(data_dir, history_filename)
-        self.load_data()
-        self.load_history()
-    
-    def load_data(self):
-        if os.path.exists(self.filename):
-            with open(self.filename, 'r', encoding='utf-8') as f:
-                self.data = json.load(f)
-        else:
-            self.data = {}
-            self.save_data()
-    
-    def save_data(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
-    
-    def load_history(self):
-        """Загрузить историю изменений рейтинга"""
-        if os.path.exists(self.history_filename):
-            with open(self.history_filename, 'r', encoding='utf-8') as f:
-                self.history = json.load(f)
-        else:
-            self.history = []
-            self.save_history()
-    
-    def save_history(self):
-        """Сохранить историю изменений рейтинга"""
-        with open(self.history_filename, 'w', encoding='utf-8') as f:
-            json.dump(self.history, f, ensure_ascii=False, indent=2)
+class RatingTransaction:
+    """Набор изменений рейтинга, который сохраняется одной записью.
+
+    Изменения копятся в транзакции и видны только через неё; в базу они
+    попадают целиком при выходе из блока with, при ошибке не попадает ничего."""
+    def __init__(self, db):
+        self.db = db
+        self.ratings = {}
+        # Суммарное изменение каждого пользователя: общее хранилище прибавляет
+        # его к своему текущему значению (ratings могли прочитать до чужой записи)
+        self.amounts = {}
+        self.history = []
+        # Рейтинги, прочитанные заранее (prefetch), - без изменений транзакции
+        self._read = {}
+    
+    def prefetch(self, user_ids):
+        """Прочитать рейтинги всех пользователей разом (у общего хранилища - одним запросом)"""
+        missing = [str(user_id) for user_id in user_ids if str(user_id) not in self.ratings]
+        if missing:
+            self._read.update(self.db.get_ratings(missing))
+    
+    def get_rating(self, user_id):
+        user_id = str(user_id)
+        if user_id in self.ratings:
+            return self.ratings[user_id]
+        if user_id in self._read:
+            return self._read[user_id]
+        return self.db.get_rating(user_id)
+    
+    def rating_before(self, user_id):
+        """Рейтинг до транзакции. После сохранения считается от значения, которое
+        вернуло хранилище: с общим хранилищем оно учитывает и чужие записи"""
+        user_id = str(user_id)
+        return self.ratings[user_id] - self.amounts.get(user_id, 0)
+    
+    def add_rating(self, user_id, amount=1, changer_id=None, comment=None):
+        user_id = str(user_id)
+        self.ratings[user_id] = self.get_rating(user_id) + amount
+        self.amounts[user_id] = self.amounts.get(user_id, 0) + amount
+        if changer_id is not None:
+            self.history.append(self.db._make_history_entry(changer_id, user_id, amount, comment))
+        return self.ratings[user_id]
+    
+    def remove_rating(self, user_id, amount=1, changer_id=None, comment=None):
+        # В историю попадает отрицательное значение
+        return self.add_rating(user_id, -amount, changer_id, comment)
     
     def add_history_entry(self, changer_id, target_id, amount, comment=None):
-        """Добавить запись в историю изменений"""
-        entry = {
+        """Запись истории без изменения рейтинга (например, итог пакетной операции)"""
+        self.history.append(self.db._make_history_entry(changer_id, target_id, amount, comment))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.db._apply_transaction(self)
+        return False
+
+class RatingDatabase:
+    """Рейтинг и история изменений поверх подключаемого хранилища (см. storage.py).
+    Без storage используется JsonStorage, которому передаются остальные аргументы"""
+    def __init__(self, *args, storage=None, **kwargs):
+        self.storage = storage if storage is not None else JsonStorage(*args, **kwargs)
+    
+    @property
+    def leaderboard(self):
+        """Упорядоченный топ хранилища (version, len(), page(), snapshot())"""
+        return self.storage.leaderboard
+    
+    @property
+    def on_dirty(self):
+        return self.storage.on_dirty
+    
+    @on_dirty.setter
+    def on_dirty(self, callback):
+        self.storage.on_dirty = callback
+    
+    @metrics.timed('rating_db_seconds')
+    def flush(self):
+        self.storage.flush()
+    
+    def close(self):
+        self.storage.close()
+    
+    def _make_history_entry(self, changer_id, target_id, amount, comment=None):
+        return {
             'timestamp': datetime.now().isoformat(),
             'changer_id': str(changer_id),
             'target_id': str(target_id),
             'amount': amount,
             'comment': comment
         }
-        self.history.append(entry)
-        # Ограничиваем историю последними 1000 записями для производительности
-        if len(self.history) > 1000:
-            self.history = self.history[-1000:]
-        self.save_history()
-    
-    def get_rating_history(self, user_id, limit=5):
-        """Получить историю изменений рейтинга для пользователя"""
-        user_id = str(user_id)
-        user_history = [entry for entry in self.history if entry['target_id'] == user_id]
-        # Сортируем по времени (новые первыми) и ограничиваем лимитом
-        user_history.sort(key=lambda x: x['timestamp'], reverse=True)
-        return user_history[:limit]
     
-    def get_recent_history(self, limit=5):
+    def add_history_entry(self, changer_id, target_id, amount, comment=None):
+        """Добавить запись в историю изменений"""
+        with self.transaction() as tx:
+            tx.add_history_entry(changer_id, target_id, amount, comment)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_rating_history(self, user_id, limit=5, offset=0):
+        """Получить историю изменений рейтинга для пользователя (новые первыми)"""
+        return self.storage.get_rating_history(user_id, limit, offset)
+    
+    @metrics.timed('rating_db_seconds')
+    def count_rating_history(self, user_id):
+        """Число изменений рейтинга пользователя за всё время"""
+        return self.storage.count_rating_history(user_id)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_changes_by(self, changer_id, limit=5, offset=0):
+        """Получить изменения рейтинга, сделанные модератором (новые первыми)"""
+        return self.storage.get_changes_by(changer_id, limit, offset)
+    
+    @metrics.timed('rating_db_seconds')
+    def count_changes_by(self, changer_id):
+        """Число изменений рейтинга, сделанных модератором за всё время"""
+        return self.storage.count_changes_by(changer_id)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_recent_history(self, limit=5, offset=0):
         """Получить последние изменения рейтинга (новые первыми)"""
-        recent = self.history[-limit:] if len(self.history) >= limit else self.history
-        # Возвращаем в обратном порядке, чтобы новые были первыми
-        return list(reversed(recent))
+        return self.storage.get_recent_history(limit, offset)
+    
+    @metrics.timed('rating_db_seconds')
+    def count_history(self):
+        """Число записей во всей истории изменений"""
+        return self.storage.count_history()
+    
+    @metrics.timed('rating_db_seconds')
+    def get_window_leaderboard(self, window):
+        """Топ по сумме изменений за последний день, неделю или месяц (day, week, month)"""
+        return self.storage.get_window_leaderboard(window)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_audit(self, window=None):
+        """Кто из модераторов сколько LP выдал и снял и кому - за окно или за всё время"""
+        return self.storage.get_audit(window)
     
+    def iter_ratings(self):
+        """(место, user_id, рейтинг) от первого места; обходить можно из рабочего потока"""
+        return self.storage.iter_ratings()
+    
+    def iter_history(self, since=None, until=None, user_id=None):
+        """Записи истории от старых к новым за [since, until), можно из рабочего потока"""
+        return self.storage.iter_history(since, until, user_id)
+    
+    @metrics.timed('rating_db_seconds')
     def get_rating(self, user_id):
-        return self.data.get(str(user_id), 0)
+        return self.storage.get_rating(user_id)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_ratings(self, user_ids):
+        return self.storage.get_ratings(user_ids)
     
+    def transaction(self):
+        """Начать транзакцию: все изменения внутри неё сохраняются одной записью"""
+        return RatingTransaction(self)
+    
+    @metrics.timed('rating_db_seconds', 'apply')
+    def _apply_transaction(self, tx):
+        """Применить изменения транзакции и сохранить их разом (всё или ничего)"""
+        self.storage.apply_transaction(tx)
+    
+    @metrics.timed('rating_db_seconds')
     def add_rating(self, user_id, amount=1, changer_id=None, comment=None):
-        user_id = str(user_id)
-        if user_id not in self.data:
-            self.data[user_id] = 0
-        self.data[user_id] += amount
-        self.save_data()
-        
-        # Добавляем запись в историю
-        if changer_id is not None:
-            self.add_history_entry(changer_id, user_id, amount, comment)
-        
-        return self.data[user_id]
+        with self.transaction() as tx:
+            tx.add_rating(user_id, amount, changer_id, comment)
+        # Итоговое значение - после сохранения (общее хранилище возвращает своё)
+        return tx.ratings[str(user_id)]
     
+    @metrics.timed('rating_db_seconds')
     def remove_rating(self, user_id, amount=1, changer_id=None, comment=None):
-        user_id = str(user_id)
-        if user_id not in self.data:
-            self.data[user_id] = 0
-        self.data[user_id] -= amount
-        self.save_data()
-        
-        # Добавляем запись в историю (с отрицательным значением)
-        if changer_id is not None:
-            self.add_history_entry(changer_id, user_id, -amount, comment)
-        
-        return self.data[user_id]
+        with self.transaction() as tx:
+            tx.remove_rating(user_id, amount, changer_id, comment)
+        return tx.ratings[str(user_id)]
     
+    @metrics.timed('rating_db_seconds')
     def get_top_users(self, limit=10):
-        sorted_users = sorted(self.data.items(), key=lambda x: x[1], reverse=True)
-        return sorted_users[:limit]
+        return self.leaderboard.top(limit)
     
+    @metrics.timed('rating_db_seconds')
     def get_bottom_users(self, limit=10):
         """Получить пользователей с наименьшим рейтингом (антитоп)"""
-        sorted_users = sorted(self.data.items(), key=lambda x: x[1], reverse=False)
-        return sorted_users[:limit]
+        return self.leaderboard.bottom(limit)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_users_page(self, offset, limit):
+        """Получить пользователей с offset-го места (с 0) по рейтингу, не больше limit"""
+        return self.leaderboard.page(offset, limit)
+    
+    @metrics.timed('rating_db_seconds')
+    def count_users(self):
+        return len(self.leaderboard)
+    
+    @metrics.timed('rating_db_seconds')
+    def get_user_rank(self, user_id):
+        """Получить место пользователя в топе (с 1) или None, если рейтинга нет"""
+        return self.leaderboard.rank(user_id)
     
+    @metrics.timed('rating_db_seconds')
     def get_all_users_sorted(self):
         """Получить всех пользователей, отсортированных по рейтингу"""
-        return sorted(self.data.items(), key=lambda x: x[1], reverse=True)
\ No newline at end of file
+        return self.leaderboard.page(0, len(self.leaderboard))
\ No newline at end of file
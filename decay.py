@@ -0,0 +1,57 @@
+import math
+from datetime import datetime, timedelta
+from windows import SERVER_USER_ID
+
+def last_decay(db):
+    """Время последнего затухания (datetime) или None, если его ещё не было.
+    Итоговая запись сохраняется той же транзакцией, что и само затухание,
+    поэтому после перезапуска повторно оно не применяется"""
+    entries = db.get_rating_history(SERVER_USER_ID, limit=1)
+    return datetime.fromisoformat(entries[0]['timestamp']) if entries else None
+
+def decay_due(db, every_days, now=None):
+    last = last_decay(db)
+    return last is None or (now or datetime.now()) - last >= timedelta(days=every_days)
+
+def compute_decay(db, percent, inactive_days, now=None):
+    """Насколько уменьшить рейтинг неактивных: {user_id: количество}.
+
+    Неактивен тот, у кого положительный рейтинг и нет изменений за последние
+    inactive_days дней; он теряет percent% рейтинга (с округлением вверх, так
+    что ниже нуля рейтинг не опускается). Один проход по истории этих дней и
+    один по рейтингам; можно вызывать из рабочего потока."""
+    since = ((now or datetime.now()) - timedelta(days=inactive_days)).isoformat()
+    active = {str(entry['target_id']) for entry in db.iter_history(since=since)}
+    amounts = {}
+    for _, user_id, rating in db.iter_ratings():
+        if rating > 0 and str(user_id) not in active:
+            amounts[str(user_id)] = math.ceil(rating * percent / 100)
+    return amounts
+
+def apply_decay(db, amounts, percent, inactive_days, changer_id):
+    """Применить затухание одной транзакцией: по пользователям - без записей
+    истории, на весь сервер - одна итоговая запись. Возвращает её сумму.
+    Если затухать нечему, ничего не записывается"""
+    if not amounts:
+        return 0
+    total = sum(amounts.values())
+    with db.transaction() as tx:
+        for user_id, amount in amounts.items():
+            tx.remove_rating(user_id, amount)
+        tx.add_history_entry(
+            changer_id, SERVER_USER_ID, -total,
+            f"Затухание рейтинга: -{percent:g}% у {len(amounts)} неактивных дольше {inactive_days} дн."
+        )
+    return total
+
+def run_decay(db, every_days, percent, inactive_days, changer_id, now=None):
+    """Затухание, если подошёл срок: {user_id: количество} или None, если срок
+    не подошёл. Проверка срока и применение идут подряд, поэтому вызывать там,
+    где между ними не вклинится другая запись (в store_server.py - в его
+    единственном рабочем потоке). Пока затухать нечему, итоговой записи нет
+    и срок проверяется заново при следующем вызове"""
+    if not decay_due(db, every_days, now):
+        return None
+    amounts = compute_decay(db, percent, inactive_days, now)
+    apply_decay(db, amounts, percent, inactive_days, changer_id)
+    return amounts
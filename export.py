@@ -0,0 +1,100 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+# Запас под данные, которые ещё в буфере сжатия, и под одну длинную строку
+PART_MARGIN = 256 * 1024
+
+RATING_COLUMNS = ('rank', 'user_id', 'name', 'rating')
+HISTORY_COLUMNS = ('timestamp', 'changer_id', 'changer_name', 'target_id', 'target_name', 'amount', 'comment')
+FORMATS = ('csv', 'jsonl')
+
+class ExportWriter:
+    """Пишет строки в сжатые файлы-части не больше part_limit байт каждая.
+
+    Строки сразу уходят в gzip на диске, поэтому в памяти держится только
+    буфер сжатия. Каждая часть - самостоятельный файл (у CSV свой заголовок),
+    если часть одна, номер в имя не добавляется."""
+    def __init__(self, directory, basename, columns, fmt='csv', part_limit=8 * 1024 * 1024):
+        self.directory = directory
+        self.basename = basename
+        self.columns = columns
+        self.fmt = fmt
+        self.part_limit = max(part_limit - PART_MARGIN, PART_MARGIN)
+        self.paths = []
+        self.rows = 0
+        self._raw = None
+    
+    def _part_path(self, number):
+        return os.path.join(self.directory, f"{self.basename}-{number}.{self.fmt}.gz")
+    
+    def _open_part(self):
+        self.paths.append(self._part_path(len(self.paths) + 1))
+        self._raw = open(self.paths[-1], 'wb')
+        self._gzip = gzip.GzipFile(filename=f"{self.basename}.{self.fmt}", mode='wb', fileobj=self._raw)
+        self._text = io.TextIOWrapper(self._gzip, encoding='utf-8', newline='')
+        if self.fmt == 'csv':
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(self.columns)
+    
+    def _close_part(self):
+        self._text.close()
+        self._raw.close()
+        self._raw = None
+    
+    def write(self, row):
+        if self._raw is None:
+            self._open_part()
+        elif self._raw.tell() >= self.part_limit:
+            self._close_part()
+            self._open_part()
+        if self.fmt == 'csv':
+            self._csv.writerow(row)
+        else:
+            self._text.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + '\n')
+        self.rows += 1
+    
+    def close(self):
+        """Закрыть последнюю часть; возвращает пути к файлам (пустой список, если строк не было)"""
+        if self._raw is not None:
+            self._close_part()
+        if len(self.paths) == 1:
+            path = os.path.join(self.directory, f"{self.basename}.{self.fmt}.gz")
+            os.replace(self.paths[0], path)
+            self.paths = [path]
+        return self.paths
+
+def rating_rows(ratings, names):
+    for rank, user_id, rating in ratings:
+        yield rank, str(user_id), names.get(int(user_id), ''), rating
+
+def history_rows(entries, names):
+    for entry in entries:
+        changer_id, target_id = entry['changer_id'], entry['target_id']
+        yield (entry['timestamp'], changer_id, names.get(int(changer_id), ''),
+               target_id, names.get(int(target_id), ''), entry['amount'], entry.get('comment') or '')
+
+def write_export(directory, fmt, part_limit, names, ratings=None, history=None):
+    """Выгрузить рейтинги и/или историю в сжатые файлы каталога directory.
+
+    ratings и history - итераторы из RatingDatabase.iter_ratings()/iter_history(),
+    names - {user_id (int): имя}. Выполняется в рабочем потоке и читает данные
+    по мере записи. Возвращает пути к файлам и {ratings/history: число строк}."""
+    paths = []
+    counts = {}
+    for basename, columns, rows in (
+        ('ratings', RATING_COLUMNS, None if ratings is None else rating_rows(ratings, names)),
+        ('history', HISTORY_COLUMNS, None if history is None else history_rows(history, names))
+    ):
+        if rows is None:
+            continue
+        writer = ExportWriter(directory, basename, columns, fmt, part_limit)
+        try:
+            for row in rows:
+                writer.write(row)
+        finally:
+            paths.extend(writer.close())
+        counts[basename] = writer.rows
+    return paths, counts
@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+class BackgroundFlusher:
+    """Фоновая запись RatingDatabase на диск вне цикла событий.
+
+    Изменения сразу применяются в памяти, а база помечается «грязной».
+    Запись выполняется в пуле потоков, когда изменения затихают на interval
+    секунд, но не позже чем через max_latency секунд после первого изменения,
+    поэтому серия быстрых команд сохраняется одной записью.
+    Хранилище с журналом подтверждает каждое изменение в журнале сразу, и в
+    фоне пишутся только история и снимок; без журнала при сбое процесса
+    теряется не больше max_latency секунд изменений."""
+    def __init__(self, db, interval=0.5, max_latency=2.0):
+        self.db = db
+        self.interval = interval
+        self.max_latency = max_latency
+        self._loop = None
+        self._dirty = None
+        self._task = None
+    
+    def start(self):
+        """Запустить фоновую запись (вызывать внутри работающего цикла событий)"""
+        self._loop = asyncio.get_running_loop()
+        self._dirty = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+        self.db.on_dirty = self.mark_dirty
+    
+    def mark_dirty(self):
+        # Может вызываться и из рабочих потоков
+        self._loop.call_soon_threadsafe(self._dirty.set)
+    
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            first_dirty = self._loop.time()
+            # Ждём паузы в изменениях, но не дольше max_latency с первого изменения
+            while True:
+                self._dirty.clear()
+                remaining = self.max_latency - (self._loop.time() - first_dirty)
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._dirty.wait(), timeout=min(self.interval, remaining))
+                except asyncio.TimeoutError:
+                    break
+            self._dirty.clear()
+            
+            try:
+                await self._loop.run_in_executor(None, self.db.flush)
+            except Exception as e:
+                print(f"Ошибка сохранения базы рейтинга: {e}")
+                await asyncio.sleep(self.interval)
+                self._dirty.set()
+    
+    @classmethod
+    def from_env(cls, db):
+        """Запись после затишья RATING_FLUSH_INTERVAL секунд, но не позже
+        RATING_FLUSH_MAX_LATENCY секунд после первого изменения"""
+        return cls(
+            db,
+            interval=float(os.getenv('RATING_FLUSH_INTERVAL', '0.5')),
+            max_latency=float(os.getenv('RATING_FLUSH_MAX_LATENCY', '2.0'))
+        )
+    
+    async def stop(self):
+        """Остановить фоновую запись и принудительно сохранить всё накопленное"""
+        self.db.on_dirty = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self.db.flush)
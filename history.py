@@ -0,0 +1,693 @@
+import json
+import os
+import sys
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from audit import AuditAggregates, copy_pairs, count_entry, merge_pairs
+from windows import TimeWindows
+
+HISTORY_FIELDS = ('target_id', 'changer_id')
+# Размер блока при чтении сегмента с конца
+TAIL_BLOCK = 64 * 1024
+# Время записи в памяти - микросекунды от этой даты (наивное время, как в ISO-строке)
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+def to_time(timestamp):
+    """ISO-время записи -> число микросекунд, как в HistoryRecord.time"""
+    return (datetime.fromisoformat(timestamp) - EPOCH) // MICROSECOND
+
+class HistoryRecord:
+    """Запись истории в памяти: время и id - числа, одинаковые комментарии - одна строка.
+
+    Занимает в несколько раз меньше словаря с ISO-строкой и строковыми id.
+    Читается как словарь записи (record['timestamp'], record.get('comment'))
+    с прежними строковыми значениями, на диск пишется тем же JSON (to_dict())."""
+    __slots__ = ('time', 'changer_id', 'target_id', 'amount', 'comment')
+    
+    def __init__(self, time, changer_id, target_id, amount, comment=None):
+        self.time = time
+        self.changer_id = changer_id
+        self.target_id = target_id
+        self.amount = amount
+        self.comment = comment
+    
+    @classmethod
+    def from_dict(cls, entry):
+        if isinstance(entry, cls):
+            return entry
+        comment = entry.get('comment')
+        return cls(
+            to_time(entry['timestamp']),
+            int(entry['changer_id']),
+            int(entry['target_id']),
+            entry['amount'],
+            sys.intern(comment) if isinstance(comment, str) else comment
+        )
+    
+    @property
+    def timestamp(self):
+        return (EPOCH + self.time * MICROSECOND).isoformat()
+    
+    def to_dict(self):
+        return {
+            'timestamp': self.timestamp,
+            'changer_id': str(self.changer_id),
+            'target_id': str(self.target_id),
+            'amount': self.amount,
+            'comment': self.comment
+        }
+    
+    def __getitem__(self, key):
+        if key == 'timestamp':
+            return self.timestamp
+        if key == 'changer_id' or key == 'target_id':
+            return str(getattr(self, key))
+        if key == 'amount' or key == 'comment':
+            return getattr(self, key)
+        raise KeyError(key)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        return ('timestamp', 'changer_id', 'target_id', 'amount', 'comment')
+    
+    def __repr__(self):
+        return f"HistoryRecord({self.to_dict()!r})"
+
+class HistoryStore:
+    """История изменений рейтинга в виде помесячных сегментов JSON Lines.
+
+    Каждый сегмент history/ГГГГ-ММ.jsonl только дописывается. Старые сегменты
+    читаются с диска по запросу и держатся в небольшом LRU-кэше. В segments.json
+    хранится, сколько записей каждого пользователя в каждом сегменте, поэтому
+    постраничный запрос пропускает ненужные сегменты, не читая их. Записи
+    пользователя внутри сегмента находятся по смещениям строк из
+    ГГГГ-ММ.offsets.json (строится при первом запросе к сегменту): последние
+    N записей читаются N обращениями к файлу, а не разбором всего месяца.
+
+    Из активного (последнего) сегмента при запуске читается только хвост из
+    tail_entries записей - блоками с конца файла. Счётчики активного сегмента
+    берутся из segments.json (там же записано, сколько байт файла они
+    покрывают), и разбирается лишь дописанное после этого. Начало активного
+    сегмента читается, только когда запросу не хватает хвоста.
+
+    windows - суммы изменений за последние день/неделю/месяц (см. windows.py);
+    их корзины по дням сохраняются вместе со счётчиками активного сегмента.
+    audit - сводка действий модераторов (см. audit.py): итоги за всё время
+    складываются из счётчиков pairs сегментов, корзины по дням хранятся
+    рядом с корзинами windows."""
+    def __init__(self, directory, index_limit=100, cache_segments=2, tail_entries=1000, cache_offsets=24):
+        self.directory = directory
+        self.manifest_filename = os.path.join(directory, 'segments.json')
+        self.index_limit = index_limit
+        self.cache_segments = cache_segments
+        self.cache_offsets = cache_offsets
+        self.tail_entries = tail_entries
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        self.segments = sorted(name[:-len('.jsonl')] for name in os.listdir(directory)
+                               if name.endswith('.jsonl'))
+        for name in self.segments:
+            self._trim_torn_line(name)
+        self.manifest = {}
+        if os.path.exists(self.manifest_filename):
+            with open(self.manifest_filename, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        self._manifest_dirty = False
+        self._cache = OrderedDict()
+        # Смещения строк сегментов по пользователям (см. _user_offsets)
+        self._offsets = OrderedDict()
+        self._unwritten = []
+        self._lock = threading.Lock()
+        
+        self.active_name = self.segments[-1] if self.segments else None
+        # self.active - хвост активного сегмента в памяти; до смещения _tail_start
+        # файл в память не читался (_active_head - его начало, если уже прочитано)
+        self.active = []
+        self._tail_start = 0
+        self._active_head = None
+        self._reset_active_stats()
+        self.windows = TimeWindows()
+        self.audit = AuditAggregates()
+        if self.active_name:
+            self._load_active()
+        
+        # Статистика для закрытых сегментов, которых нет в segments.json или которые
+        # дописывались после её сохранения (например, после сбоя)
+        for name in self.segments[:-1]:
+            stats = self.manifest.get(name)
+            if (stats is None or stats.get('bytes', None) not in (None, self._segment_size(name))
+                    or 'pairs' not in stats):
+                self.manifest[name] = self._segment_stats(self._read_file(name))
+                self._manifest_dirty = True
+        for name in self.segments:
+            merge_pairs(self.audit.totals, self._stats(name).get('pairs', {}))
+    
+    @staticmethod
+    def segment_name(entry):
+        # ISO-время начинается с ГГГГ-ММ
+        return entry['timestamp'][:7]
+    
+    def _segment_filename(self, name):
+        return os.path.join(self.directory, name + '.jsonl')
+    
+    def _segment_size(self, name):
+        path = self._segment_filename(name)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    
+    def _trim_torn_line(self, name):
+        """Обрезать оборванную последнюю строку сегмента (сбой во время записи),
+        иначе следующая запись приклеится к ней и тоже не прочитается.
+        Сама запись восстановится из журнала"""
+        path = self._segment_filename(name)
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            end = size
+            while end > 0:
+                step = min(TAIL_BLOCK, end)
+                f.seek(end - step)
+                newline = f.read(step).rfind(b'\n')
+                if newline >= 0:
+                    end = end - step + newline + 1
+                    break
+                end -= step
+            if end < size:
+                print(f"Сегмент истории {path}: обрезана оборванная запись ({size - end} байт)")
+                f.truncate(end)
+                os.fsync(f.fileno())
+    
+    def _parse_line(self, line, path):
+        try:
+            return HistoryRecord.from_dict(json.loads(line))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            # Оборванная строка после сбоя; запись восстановится из журнала
+            print(f"Сегмент истории {path}: пропущена поврежденная запись")
+            return None
+    
+    def _iter_range(self, name, start=0, end=None):
+        """Записи сегмента из байтов файла [start, end)"""
+        path = self._segment_filename(name)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            position = start
+            for line in f:
+                if end is not None and position >= end:
+                    break
+                position += len(line)
+                if not line.strip():
+                    continue
+                entry = self._parse_line(line, path)
+                if entry is not None:
+                    yield entry
+    
+    def _read_file(self, name):
+        return list(self._iter_range(name))
+    
+    def _read_tail(self, name, max_entries):
+        """Последние max_entries записей сегмента и смещение первой из них в файле.
+        Файл читается блоками с конца, пока в буфере не наберётся нужное число строк"""
+        path = self._segment_filename(name)
+        if not os.path.exists(path):
+            return [], 0
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            buffer = b''
+            while position > 0 and buffer.count(b'\n') <= max_entries:
+                step = min(TAIL_BLOCK, position)
+                position -= step
+                f.seek(position)
+                buffer = f.read(step) + buffer
+        
+        lines = buffer.split(b'\n')
+        if position > 0:
+            # Первая строка буфера - обрезанный конец более ранней записи
+            position += len(lines.pop(0)) + 1
+        # Лишние строки в начале буфера пропускаем, сдвигая смещение
+        extra = sum(1 for line in lines if line.strip()) - max_entries
+        while extra > 0:
+            line = lines.pop(0)
+            position += len(line) + 1
+            if line.strip():
+                extra -= 1
+        
+        entries = []
+        for line in lines:
+            if line.strip():
+                entry = self._parse_line(line, path)
+                if entry is not None:
+                    entries.append(entry)
+        return entries, position
+    
+    def _load_active(self):
+        """Прочитать хвост активного сегмента и восстановить его счётчики"""
+        size = self._segment_size(self.active_name)
+        self.active, self._tail_start = self._read_tail(self.active_name, self.tail_entries)
+        for entry in self.active:
+            self._index_entry(entry)
+        
+        saved = self.manifest.get(self.active_name)
+        start = 0
+        if (saved is not None and saved.get('bytes') is not None and saved['bytes'] <= size
+                and 'days' in saved and 'audit_days' in saved):
+            self.active_stats['count'] = saved['count']
+            for field in HISTORY_FIELDS:
+                self.active_stats[field] = dict(saved.get(field, {}))
+            self.active_stats['pairs'] = copy_pairs(saved.get('pairs', {}))
+            self.windows.load(saved['days'])
+            self.audit.load(saved['audit_days'])
+            start = saved['bytes']
+        else:
+            # Окна заново: из закрытых сегментов берутся только месяцы, которые в них попадают
+            first_month = self.windows.first_day()[:7]
+            for name in self.segments[:-1]:
+                if name >= first_month:
+                    for entry in self._iter_range(name):
+                        self.windows.add(entry)
+                        self.audit.add_day(entry)
+        # Без сохранённых счётчиков сегмент один раз просматривается целиком, не оставаясь в памяти
+        for entry in self._iter_range(self.active_name, start):
+            self._count_stats(entry)
+            self.windows.add(entry)
+            self.audit.add_day(entry)
+    
+    def _segment_stats(self, entries):
+        stats = {'count': len(entries)}
+        for field in HISTORY_FIELDS:
+            counts = stats[field] = {}
+            for entry in entries:
+                counts[entry[field]] = counts.get(entry[field], 0) + 1
+        pairs = stats['pairs'] = {}
+        for entry in entries:
+            count_entry(pairs, entry)
+        return stats
+    
+    def _reset_active_stats(self):
+        self.active_stats = {'count': 0, 'pairs': {}}
+        self._index = {}
+        for field in HISTORY_FIELDS:
+            self.active_stats[field] = {}
+            self._index[field] = {}
+    
+    def _count_stats(self, entry):
+        self.active_stats['count'] += 1
+        for field in HISTORY_FIELDS:
+            counts = self.active_stats[field]
+            counts[entry[field]] = counts.get(entry[field], 0) + 1
+        count_entry(self.active_stats['pairs'], entry)
+    
+    def _index_entry(self, entry):
+        # Последние index_limit записей пользователя - без прохода по сегменту
+        for field in HISTORY_FIELDS:
+            key = getattr(entry, field)
+            entries = self._index[field].get(key)
+            if entries is None:
+                entries = self._index[field][key] = deque(maxlen=self.index_limit)
+            entries.append(entry)
+    
+    def migrate_from(self, path):
+        """Перенести историю из старого history.json в сегменты"""
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        for entry in entries:
+            self.add(entry)
+        self.write(self.take_unwritten(), sync=True)
+        self.write_manifest(self.take_manifest(include_active=True))
+        os.replace(path, path + '.migrated')
+    
+    def add(self, entry):
+        """Добавить запись в память; на диск она попадёт при write().
+        Возвращает запись в компактном виде (её же передавать в discard())"""
+        entry = HistoryRecord.from_dict(entry)
+        name = self.segment_name(entry)
+        if self.active_name is None or name > self.active_name:
+            self._rotate(name)
+        # Запись «из прошлого» (например, после перевода часов) остаётся в активном сегменте
+        self.active.append(entry)
+        self._count_stats(entry)
+        self._index_entry(entry)
+        self.windows.add(entry)
+        self.audit.add(entry)
+        with self._lock:
+            self._unwritten.append((self.active_name, entry))
+        return entry
+    
+    def _rotate(self, name):
+        """Закрыть активный сегмент и начать новый"""
+        if self.active_name is not None:
+            self.manifest[self.active_name] = {
+                'count': self.active_stats['count'],
+                **{field: dict(self.active_stats[field]) for field in HISTORY_FIELDS},
+                'pairs': self.active_stats['pairs']
+            }
+            self._manifest_dirty = True
+            # В кэш - только если сегмент уже целиком в памяти
+            if self._tail_start == 0 or self._active_head is not None:
+                self._cache_segment(self.active_name, self._full_active())
+        self.segments.append(name)
+        self.active_name = name
+        self.active = []
+        self._tail_start = 0
+        self._active_head = None
+        self._reset_active_stats()
+    
+    def discard(self, entries):
+        """Убрать из памяти только что добавленные записи (откат транзакции)"""
+        discarded = set(map(id, entries))
+        with self._lock:
+            self._unwritten = [item for item in self._unwritten if id(item[1]) not in discarded]
+        kept = []
+        for entry in self.active:
+            if id(entry) not in discarded:
+                kept.append(entry)
+                continue
+            self.windows.discard(entry)
+            self.audit.discard(entry)
+            count_entry(self.active_stats['pairs'], entry, sign=-1)
+            self.active_stats['count'] -= 1
+            for field in HISTORY_FIELDS:
+                counts = self.active_stats[field]
+                counts[entry[field]] -= 1
+                if not counts[entry[field]]:
+                    del counts[entry[field]]
+                indexed = self._index[field].get(getattr(entry, field))
+                if indexed is not None:
+                    self._index[field][getattr(entry, field)] = deque(
+                        (item for item in indexed if item is not entry), maxlen=self.index_limit)
+        self.active = kept
+    
+    def take_unwritten(self):
+        with self._lock:
+            unwritten, self._unwritten = self._unwritten, []
+        return unwritten
+    
+    def restore_unwritten(self, unwritten):
+        """Вернуть записи, которые не удалось записать; segments.json тоже будет записан заново"""
+        with self._lock:
+            self._unwritten[:0] = unwritten
+            self._manifest_dirty = True
+    
+    def segment_sizes(self, unwritten):
+        """Размеры файлов сегментов, в которые пойдут записи, - для truncate()"""
+        return {name: self._segment_size(name) for name in dict.fromkeys(name for name, _ in unwritten)}
+    
+    def truncate(self, sizes):
+        """Обрезать сегменты до размеров из segment_sizes(), отменив дописанное после них"""
+        for name, size in sizes.items():
+            path = self._segment_filename(name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+                    os.fsync(f.fileno())
+                # Смещения могли захватить отменённые строки - построятся заново
+                self._offsets.pop(name, None)
+                if os.path.exists(self._offsets_filename(name)):
+                    os.remove(self._offsets_filename(name))
+    
+    def write(self, unwritten, sync=False):
+        """Дописать записи в файлы их сегментов (можно вызывать из рабочего потока).
+        Записи попадают в файлы все или ни одной: при ошибке дописанное обрезается.
+        Возвращает число записанных байт"""
+        by_segment = {}
+        for name, entry in unwritten:
+            by_segment.setdefault(name, []).append(entry)
+        sizes = self.segment_sizes(unwritten)
+        written = 0
+        try:
+            for name, entries in by_segment.items():
+                payload = ''.join(json.dumps(entry.to_dict(), ensure_ascii=False) + '\n' for entry in entries)
+                with open(self._segment_filename(name), 'a', encoding='utf-8') as f:
+                    f.write(payload)
+                    if sync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                written += len(payload.encode('utf-8'))
+        except Exception:
+            self.truncate(sizes)
+            raise
+        return written
+    
+    def take_manifest(self, include_active=False):
+        """Копия segments.json для записи, если он изменился (иначе None).
+
+        С include_active в неё попадают и счётчики активного сегмента; вызывать
+        вместе с take_unwritten(), чтобы счётчики совпадали с записанным в файл."""
+        if not self._manifest_dirty and not include_active:
+            return None
+        self._manifest_dirty = False
+        manifest = dict(self.manifest)
+        if include_active and self.active_name is not None:
+            manifest[self.active_name] = {
+                'count': self.active_stats['count'],
+                **{field: dict(self.active_stats[field]) for field in HISTORY_FIELDS},
+                'pairs': copy_pairs(self.active_stats['pairs']),
+                'days': self.windows.snapshot(),
+                'audit_days': self.audit.snapshot(),
+                # Размер файла подставит write_manifest после записи сегмента
+                'bytes': None
+            }
+        return manifest
+    
+    def write_manifest(self, manifest):
+        if manifest is None:
+            return
+        for name, stats in manifest.items():
+            if 'bytes' in stats and stats['bytes'] is None:
+                stats['bytes'] = self._segment_size(name)
+        tmp_path = self.manifest_filename + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_filename)
+    
+    def _cache_segment(self, name, entries):
+        self._cache[name] = entries
+        self._cache.move_to_end(name)
+        while len(self._cache) > self.cache_segments:
+            self._cache.popitem(last=False)
+    
+    def _full_active(self):
+        """Активный сегмент целиком; начало файла читается при первом обращении"""
+        if self._tail_start == 0:
+            return self.active
+        if self._active_head is None:
+            self._active_head = list(self._iter_range(self.active_name, 0, self._tail_start))
+        return self._active_head + self.active
+    
+    def _offsets_filename(self, name):
+        return os.path.join(self.directory, name + '.offsets.json')
+    
+    def _user_offsets(self, name, end):
+        """Смещения строк сегмента в байтах [0, end) по пользователям:
+        {field: {user_id строкой: [смещения по порядку]}}.
+
+        Сегмент только дописывается, поэтому смещения строятся один раз и
+        дополняются дописанным; сохраняются рядом с сегментом, чтобы после
+        перезапуска его не разбирать"""
+        offsets = self._offsets.get(name)
+        if offsets is None:
+            offsets = self._load_offsets(name)
+        if offsets is not None and offsets['bytes'] > self._segment_size(name):
+            # Сегмент обрезан после сбоя
+            offsets = None
+        if offsets is None:
+            offsets = {'bytes': 0, **{field: {} for field in HISTORY_FIELDS}}
+        if offsets['bytes'] < end:
+            path = self._segment_filename(name)
+            with open(path, 'rb') as f:
+                f.seek(offsets['bytes'])
+                position = offsets['bytes']
+                for line in f:
+                    if position >= end:
+                        break
+                    if line.strip():
+                        entry = self._parse_line(line, path)
+                        if entry is not None:
+                            for field in HISTORY_FIELDS:
+                                offsets[field].setdefault(str(getattr(entry, field)), []).append(position)
+                    position += len(line)
+            offsets['bytes'] = position
+            self._save_offsets(name, offsets)
+        self._offsets[name] = offsets
+        self._offsets.move_to_end(name)
+        while len(self._offsets) > self.cache_offsets:
+            self._offsets.popitem(last=False)
+        return offsets
+    
+    def _load_offsets(self, name):
+        try:
+            with open(self._offsets_filename(name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _save_offsets(self, name, offsets):
+        # Без fsync: при потере файл просто построится заново
+        tmp_path = self._offsets_filename(name) + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(offsets, f)
+            os.replace(tmp_path, self._offsets_filename(name))
+        except OSError as e:
+            print(f"Не удалось сохранить смещения сегмента истории {name}: {e}")
+    
+    def _read_at(self, name, positions):
+        """Записи сегмента, начинающиеся со смещений positions"""
+        path = self._segment_filename(name)
+        entries = []
+        with open(path, 'rb') as f:
+            for position in positions:
+                f.seek(position)
+                entry = self._parse_line(f.readline(), path)
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+    
+    def _user_entries(self, name, field, key, user_id, skip, need):
+        """Записи пользователя в сегменте (новые первыми) с skip по skip + need.
+        Прочитанное в память берётся из памяти, остальное - по смещениям строк"""
+        if name in self._cache or name == self.active_name and self._active_head is not None:
+            entries = self.read_segment(name)
+            return list(islice((entry for entry in reversed(entries) if getattr(entry, field) == user_id),
+                               skip, skip + need))
+        result = []
+        end = self._segment_size(name)
+        if name == self.active_name:
+            # Хвост - в памяти; если индекс не заполнен до предела, в нём все записи хвоста
+            indexed = self._index[field].get(user_id, ())
+            if len(indexed) < self.index_limit:
+                in_memory = list(reversed(indexed))
+            else:
+                in_memory = [entry for entry in reversed(self.active) if getattr(entry, field) == user_id]
+            result = in_memory[skip:skip + need]
+            skip = max(0, skip - len(in_memory))
+            need -= len(result)
+            end = self._tail_start
+        if need > 0 and end > 0:
+            positions = self._user_offsets(name, end)[field].get(key, [])
+            # Смещения могли быть построены дальше end (в активном сегменте там уже хвост)
+            stop = bisect_left(positions, end) - skip
+            result.extend(self._read_at(name, reversed(positions[max(0, stop - need):max(0, stop)])))
+        return result
+    
+    def read_segment(self, name):
+        """Записи сегмента в порядке времени; закрытые сегменты читаются лениво"""
+        if name == self.active_name:
+            return self._full_active()
+        entries = self._cache.get(name)
+        if entries is None:
+            entries = self._read_file(name)
+        self._cache_segment(name, entries)
+        return entries
+    
+    def iter_all(self):
+        """Все записи от старых к новым, по одному сегменту за раз (без кэширования)"""
+        for name in self.segments:
+            if name == self.active_name:
+                if self._active_head is not None:
+                    yield from self._active_head
+                else:
+                    yield from self._iter_range(name, 0, self._tail_start)
+                yield from self.active
+            elif name in self._cache:
+                yield from self._cache[name]
+            else:
+                yield from self._iter_range(name)
+    
+    def iter_entries(self, since=None, until=None, user_id=None):
+        """Записи от старых к новым со временем since <= t < until (ISO-строки);
+        с user_id - только изменения этого пользователя и сделанные им.
+
+        Набор записей фиксируется при вызове (вызывать под той же блокировкой,
+        что и add()), а читаются они по одному сегменту. Поэтому генератор можно
+        обходить из рабочего потока, пока бот продолжает принимать изменения.
+        Сегменты отбираются по месяцу в имени."""
+        start = to_time(since) if since else None
+        end = to_time(until) if until else None
+        user_id = int(user_id) if user_id is not None else None
+        names = [name for name in self.segments
+                 if (since is None or name >= since[:7]) and (until is None or name <= until[:7])]
+        active_name = self.active_name
+        # add() только дописывает в self.active, а discard() и _rotate() заменяют список
+        active, active_count = self.active, len(self.active)
+        head, tail_start = self._active_head, self._tail_start
+        
+        def segment_entries(name):
+            if name != active_name:
+                cached = self._cache.get(name)
+                return cached if cached is not None else self._iter_range(name)
+            if head is not None:
+                return chain(head, islice(active, active_count))
+            return chain(self._iter_range(name, 0, tail_start), islice(active, active_count))
+        
+        def entries():
+            for name in names:
+                for entry in segment_entries(name):
+                    if start is not None and entry.time < start or end is not None and entry.time >= end:
+                        continue
+                    if user_id is not None and entry.target_id != user_id and entry.changer_id != user_id:
+                        continue
+                    yield entry
+        return entries()
+    
+    def _stats(self, name):
+        if name == self.active_name:
+            return self.active_stats
+        return self.manifest.get(name) or {'count': 0}
+    
+    def last_timestamp(self):
+        return self.active[-1]['timestamp'] if self.active else ''
+    
+    def count(self, field=None, key=None):
+        """Число записей всего или для пользователя (field - target_id/changer_id)"""
+        total = 0
+        for name in self.segments:
+            stats = self._stats(name)
+            total += stats['count'] if field is None else stats.get(field, {}).get(str(key), 0)
+        return total
+    
+    def query(self, field=None, key=None, offset=0, limit=5):
+        """Записи (новые первыми) со смещением offset; без field - вся история.
+
+        Сегменты, в которых нет записей пользователя или которые целиком
+        попадают в смещение, пропускаются без чтения с диска. В активном
+        сегменте сначала используются хвост и индекс в памяти."""
+        # В счётчиках id - строки (как в segments.json), в записях и индексе - числа
+        key = str(key) if key is not None else None
+        user_id = int(key) if key is not None else None
+        result = []
+        skip = offset
+        for name in reversed(self.segments):
+            if len(result) >= limit:
+                break
+            stats = self._stats(name)
+            count = stats['count'] if field is None else stats.get(field, {}).get(key, 0)
+            if skip >= count:
+                skip -= count
+                continue
+            need = limit - len(result)
+            if field is None:
+                if name == self.active_name and skip + need <= len(self.active):
+                    entries = self.active
+                else:
+                    entries = self.read_segment(name)
+                matches = islice(reversed(entries), skip, skip + need)
+            elif name == self.active_name and skip + need <= len(self._index[field].get(user_id, ())):
+                matches = islice(reversed(self._index[field][user_id]), skip, skip + need)
+            else:
+                matches = self._user_entries(name, field, key, user_id, skip, need)
+            result.extend(matches)
+            skip = 0
+        return result
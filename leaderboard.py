@@ -0,0 +1,221 @@
+import math
+import random
+import weakref
+
+MAX_LEVELS = 24
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+    
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        # width[i] - сколько позиций перескакивает ссылка next[i]
+        self.width = [1] * levels
+
+class LeaderboardSnapshot:
+    """Топ, зафиксированный на одной версии лидерборда.
+
+    Пока лидерборд не меняется, снимок читает страницы прямо из него и ничего
+    не копирует. Перед первым изменением лидерборд один раз копирует порядок
+    пользователей, и эта копия общая для всех снимков этой версии."""
+    def __init__(self, leaderboard):
+        self.version = leaderboard.version
+        self._leaderboard = leaderboard
+        self._users = None
+    
+    def __len__(self):
+        if self._users is not None:
+            return len(self._users)
+        return len(self._leaderboard)
+    
+    def page(self, offset, limit):
+        if self._users is not None:
+            offset = max(offset, 0)
+            return self._users[offset:offset + limit]
+        return self._leaderboard.page(offset, limit)
+    
+    def read_page(self, offset, limit):
+        return self.version, len(self), self.page(offset, limit)
+
+class VersionedLeaderboard:
+    """Общая часть упорядоченных топов: версия и снимки.
+
+    Наследник реализует __len__() и page(offset, limit) и вызывает
+    _before_change() перед каждым изменением."""
+    def __init__(self):
+        self.version = 0
+        self._snapshots = weakref.WeakSet()
+    
+    def snapshot(self):
+        """Зафиксировать текущую версию топа (копирование - только при изменении)"""
+        snapshot = LeaderboardSnapshot(self)
+        self._snapshots.add(snapshot)
+        return snapshot
+    
+    def _before_change(self):
+        if self._snapshots:
+            users = self.page(0, len(self))
+            for snapshot in list(self._snapshots):
+                snapshot._users = users
+                snapshot._leaderboard = None
+            self._snapshots = weakref.WeakSet()
+        self.version += 1
+    
+    def top(self, limit=10):
+        return self.page(0, limit)
+    
+    def read_page(self, offset, limit):
+        """Версия, число пользователей и страница вместе (у общего хранилища - одним запросом)"""
+        return self.version, len(self), self.page(offset, limit)
+    
+    def bottom(self, limit=10):
+        """Пользователи с наименьшим рейтингом, начиная с худшего"""
+        limit = min(limit, len(self))
+        return list(reversed(self.page(len(self) - limit, limit)))
+
+class Leaderboard(VersionedLeaderboard):
+    """Упорядоченный индекс рейтинга (индексируемый skip list).
+
+    Пользователи отсортированы по ключу (-рейтинг, user_id), то есть от
+    лучшего к худшему. Изменение рейтинга и место пользователя - O(log n),
+    страница из k пользователей с любого места - O(log n + k).
+
+    Внутри user_id хранятся числами (снежинки Discord), страницы отдают их
+    строками, как и раньше. ratings - словарь {user_id: рейтинг} индекса;
+    хранилище может пользоваться им вместо собственной копии.
+
+    version увеличивается при каждом изменении, поэтому по нему можно
+    кэшировать готовые страницы."""
+    def __init__(self, ratings=None):
+        super().__init__()
+        self.rebuild(ratings or {})
+    
+    def rebuild(self, ratings):
+        """Построить индекс заново за O(n log n) (сортировка) + O(n) (связывание)"""
+        self._before_change()
+        self._ratings = {int(user_id): rating for user_id, rating in ratings.items()}
+        self._size = 0
+        self._tail = _Node(None, 0)
+        self._head = _Node(None, MAX_LEVELS)
+        self._head.next = [self._tail] * MAX_LEVELS
+        
+        last = [self._head] * MAX_LEVELS
+        last_position = [0] * MAX_LEVELS
+        keys = sorted((-rating, user_id) for user_id, rating in self._ratings.items())
+        for position, key in enumerate(keys, start=1):
+            node = _Node(key, self._random_levels())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - last_position[level]
+                last[level] = node
+                last_position[level] = position
+        self._size = len(keys)
+        for level in range(MAX_LEVELS):
+            last[level].next[level] = self._tail
+            last[level].width[level] = self._size + 1 - last_position[level]
+    
+    @staticmethod
+    def _random_levels():
+        return min(MAX_LEVELS, 1 - int(math.log(1.0 - random.random(), 2.0)))
+    
+    @property
+    def ratings(self):
+        return self._ratings
+    
+    def __len__(self):
+        return self._size
+    
+    def __contains__(self, user_id):
+        return int(user_id) in self._ratings
+    
+    def _find(self, key):
+        """Последний узел с ключом меньше key на каждом уровне и число пройденных позиций"""
+        chain = [None] * MAX_LEVELS
+        steps = [0] * MAX_LEVELS
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not self._tail and node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps
+    
+    def _insert(self, key):
+        chain, steps_at_level = self._find(key)
+        node = _Node(key, self._random_levels())
+        steps = 0
+        for level in range(len(node.next)):
+            previous = chain[level]
+            node.next[level] = previous.next[level]
+            previous.next[level] = node
+            node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(len(node.next), MAX_LEVELS):
+            chain[level].width[level] += 1
+        self._size += 1
+    
+    def _remove(self, key):
+        chain, _ = self._find(key)
+        node = chain[0].next[0]
+        if node is self._tail or node.key != key:
+            raise KeyError(key)
+        for level in range(len(node.next)):
+            previous = chain[level]
+            previous.width[level] += node.width[level] - 1
+            previous.next[level] = node.next[level]
+        for level in range(len(node.next), MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self._size -= 1
+    
+    def update(self, user_id, rating):
+        """Установить рейтинг пользователя за O(log n)"""
+        user_id = int(user_id)
+        old_rating = self._ratings.get(user_id)
+        if old_rating == rating:
+            return
+        self._before_change()
+        if old_rating is not None:
+            self._remove((-old_rating, user_id))
+        self._ratings[user_id] = rating
+        self._insert((-rating, user_id))
+    
+    def discard(self, user_id):
+        user_id = int(user_id)
+        rating = self._ratings.pop(user_id, None)
+        if rating is not None:
+            self._before_change()
+            self._remove((-rating, user_id))
+    
+    def rank(self, user_id):
+        """Место пользователя (с 1) или None, если у него нет рейтинга"""
+        user_id = int(user_id)
+        rating = self._ratings.get(user_id)
+        if rating is None:
+            return None
+        _, steps = self._find((-rating, user_id))
+        return sum(steps) + 1
+    
+    def _node_at(self, index):
+        node = self._head
+        remaining = index + 1
+        for level in reversed(range(MAX_LEVELS)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node
+    
+    def page(self, offset, limit):
+        """Пользователи с offset-го места (с 0), не больше limit, как (user_id, рейтинг)"""
+        if offset < 0:
+            offset = 0
+        if limit <= 0 or offset >= self._size:
+            return []
+        node = self._node_at(offset)
+        result = []
+        while node is not self._tail and len(result) < limit:
+            rating, user_id = node.key
+            result.append((str(user_id), -rating))
+            node = node.next[0]
+        return result
@@ -1,10 +1,27 @@
+import asyncio
+import csv
+import functools
+import io
+import re
+import tempfile
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ui import Button, View
 import os
+import time
 from dotenv import load_dotenv
-from database import RatingDatabase
-from datetime import datetime
+from shards import shards_from_env
+from remote_storage import RemoteShards, StoreClient
+from flusher import BackgroundFlusher
+from names import NameResolver
+from metrics import dump_periodically, metrics, serve_http
+from export import FORMATS, write_export
+from decay import apply_decay, compute_decay, decay_due
+from audit import summarize_moderators, summarize_targets
+from datetime import datetime, timedelta
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -14,15 +31,227 @@ intents = discord.Intents.default()
 intents.messages = True
 intents.message_content = True
 intents.reactions = True
+# Кэш участников нужен для имён без REST-запросов и для on_member_update
+# (привилегированный интент: включается в Developer Portal)
+intents.members = True
 
-# Создание бота
-bot = commands.Bot(command_prefix='!', intents=intents)
-db = RatingDatabase()
+# Создание бота. Участников загружает прогрев после on_ready и только для серверов
+# с рейтингом, поэтому команды начинают приниматься сразу после подключения
+bot = commands.Bot(command_prefix='!', intents=intents, chunk_guilds_at_startup=False)
+
+# RATING_STORE_ADDRESS - общее хранилище store_server.py (unix:/путь или хост:порт),
+# к которому могут подключаться несколько процессов бота; без него каждая база
+# сервера открывается в этом процессе при первой команде
+store_address = os.getenv('RATING_STORE_ADDRESS')
+shards = RemoteShards(StoreClient(store_address)) if store_address else shards_from_env()
+names = NameResolver(bot)
+# Запись базы на диск идёт в фоне (с общим хранилищем её делает store_server.py)
+flusher = BackgroundFlusher.from_env(shards)
+
+# Значения, которые считаются при каждом чтении метрик
+metrics.gauge('rating_loaded_guilds', lambda: len(shards.loaded_guilds()))
+metrics.gauge('rating_users', lambda: sum(len(db.leaderboard) for db in shards))
+metrics.gauge('rating_history_entries', lambda: sum(db.storage.count_history() for db in shards))
+metrics.gauge('rating_top_page_cache_hits', lambda: top_page_cache.hits)
+metrics.gauge('rating_top_page_cache_misses', lambda: top_page_cache.misses)
+for stat in names.stats:
+    metrics.gauge(f'rating_names_{stat}', lambda stat=stat: names.stats[stat])
+# Фоновая задача и HTTP-сервер метрик (ссылки держим, чтобы их не собрал сборщик мусора)
+metrics_tasks = []
+# Затухание рейтинга: раз в RATING_DECAY_EVERY_DAYS дней все, у кого не было изменений
+# RATING_DECAY_INACTIVE_DAYS дней, теряют RATING_DECAY_PERCENT% (0 - выключено)
+DECAY_PERCENT = float(os.getenv('RATING_DECAY_PERCENT', '0'))
+DECAY_INACTIVE_DAYS = int(os.getenv('RATING_DECAY_INACTIVE_DAYS', '14'))
+DECAY_EVERY_DAYS = float(os.getenv('RATING_DECAY_EVERY_DAYS', '7'))
+# Прогрев после запуска: скольким пользователям из начала топа заранее запросить
+# имена, если их нет среди участников сервера (например, ушедшим)
+WARMUP_NAMES = int(os.getenv('RATING_WARMUP_NAMES', '200'))
+warmup_task = None
+
+@bot.event
+async def setup_hook():
+    flusher.start()
+    # Текстовые метрики: в файл RATING_METRICS_FILE раз в RATING_METRICS_INTERVAL секунд
+    # и/или по адресу http://127.0.0.1:RATING_METRICS_PORT/
+    metrics_file = os.getenv('RATING_METRICS_FILE')
+    if metrics_file:
+        interval = float(os.getenv('RATING_METRICS_INTERVAL', '60'))
+        metrics_tasks.append(asyncio.create_task(dump_periodically(metrics, metrics_file, interval)))
+    metrics_port = os.getenv('RATING_METRICS_PORT')
+    if metrics_port:
+        metrics_tasks.append(await serve_http(metrics, int(metrics_port)))
+    if DECAY_PERCENT > 0:
+        decay_ratings.start()
+
+@tasks.loop(hours=1)
+async def decay_ratings():
+    """Затухание рейтинга неактивных пользователей на каждом сервере, когда подошёл срок"""
+    try:
+        stored = set(await asyncio.to_thread(shards.stored_guilds))
+    except Exception as e:
+        print(f"Ошибка затухания рейтинга: {e}")
+        return
+    for guild in bot.guilds:
+        # Серверу без сохранённого рейтинга затухать нечему, базу ему не создаём
+        if guild.id not in stored:
+            continue
+        try:
+            started = time.perf_counter()
+            amounts = await decay_guild(guild)
+            # None - срок не подошёл, пустой словарь - затухать некому
+            if not amounts:
+                continue
+            metrics.observe('rating_decay_seconds', 'run', time.perf_counter() - started)
+            print(f"Затухание рейтинга на сервере {guild.id}: {len(amounts)} пользователей, -{sum(amounts.values())} LP")
+        except Exception as e:
+            print(f"Ошибка затухания рейтинга на сервере {guild.id}: {e}")
+
+async def decay_guild(guild):
+    """Затухание на сервере, если подошёл срок: {user_id: количество} или None"""
+    # Базы, ещё не открытые командами, открываются в рабочем потоке
+    db = await asyncio.to_thread(shards.get, guild.id)
+    if isinstance(shards, RemoteShards):
+        # Срок и применение - один запрос: два процесса бота не применят затухание дважды
+        return await asyncio.to_thread(
+            db.storage.run_decay, DECAY_EVERY_DAYS, DECAY_PERCENT, DECAY_INACTIVE_DAYS, bot.user.id)
+    if not await run_db(decay_due, db, DECAY_EVERY_DAYS):
+        return None
+    # Проход по истории и рейтингам - в отдельном потоке, чтобы не задерживать команды;
+    # применение - одна транзакция в очереди команд
+    amounts = await asyncio.to_thread(compute_decay, db, DECAY_PERCENT, DECAY_INACTIVE_DAYS)
+    await run_db(apply_decay, db, amounts, DECAY_PERCENT, DECAY_INACTIVE_DAYS, bot.user.id)
+    return amounts
+
+@decay_ratings.before_loop
+async def before_decay_ratings():
+    await bot.wait_until_ready()
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_latency(ctx):
+    # Вызывается и после ошибки в команде
+    started_at = getattr(ctx, 'started_at', None)
+    if started_at is not None:
+        metrics.observe('rating_command_seconds', ctx.command.qualified_name, time.perf_counter() - started_at)
+
+@bot.event
+async def on_member_update(before, after):
+    names.invalidate(after.id)
+
+@bot.event
+async def on_user_update(before, after):
+    names.invalidate(after.id)
+
+@bot.check
+async def guild_only(ctx):
+    # Рейтинг ведётся отдельно для каждого сервера, в личных сообщениях его нет
+    return ctx.guild is not None
+
+async def get_db(ctx):
+    """База рейтинга сервера, с которого пришла команда. Ещё не открытая база
+    загружается в рабочем потоке: цикл событий не ждёт ни разбора файлов, ни
+    прогрева или затухания, которые открывают эту же базу"""
+    db = shards.get_loaded(ctx.guild.id)
+    if db is None:
+        db = await asyncio.to_thread(shards.get, ctx.guild.id)
+    return db
+
+# Локальные базы читаются и меняются по очереди в одном рабочем потоке: запись
+# в журнал с fsync не задерживает цикл событий, а индексы топа и истории не
+# меняются, пока их читает другая команда
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rating-db')
+
+async def run_db(func, *args):
+    """Обращение к базе из команды; ответа ждёт рабочий поток, а не цикл событий.
+    С общим хранилищем (store_server.py) запросы одновременных команд идут по
+    соединению вперемешку, к локальным базам - по очереди в db_executor"""
+    if isinstance(shards, RemoteShards):
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(func, *args))
 
 @bot.event
 async def on_ready():
     print(f'Бот {bot.user} запущен!')
+    # Общее хранилище старых версий принадлежит серверу с ролями семьи
+    family_guild = next((guild for guild in bot.guilds
+                         if guild.get_role(SONS_ROLE_ID) or guild.get_role(GRANDFATHERS_ROLE_ID)), None)
+    if family_guild is not None:
+        await run_db(claim_legacy_guild, family_guild.id)
     await bot.change_presence(activity=discord.Game(name="!help для справки"))
+    # on_ready повторяется после переподключений, прогрев нужен один раз
+    global warmup_task
+    if warmup_task is None:
+        warmup_task = asyncio.create_task(warm_up())
+
+def claim_legacy_guild(guild_id):
+    # Сервер, назначенный раньше (RATING_LEGACY_GUILD_ID или прошлый on_ready), не меняется
+    if shards.legacy_guild_id is None:
+        shards.legacy_guild_id = guild_id
+
+async def warm_up():
+    """Подготовить серверы с рейтингом к первым командам.
+    Идёт в фоне: команды, пришедшие раньше, отвечают по тому, что уже загружено
+    (имена, которых ещё нет в кэшах, запрашиваются как обычно)"""
+    started = time.perf_counter()
+    stored = set(await asyncio.to_thread(shards.stored_guilds))
+    guilds = [guild for guild in bot.guilds if guild.id in stored]
+    for guild in guilds:
+        try:
+            await warm_up_guild(guild)
+        except Exception as e:
+            print(f"Ошибка прогрева сервера {guild.id}: {e}")
+    print(f"Прогрев завершён за {time.perf_counter() - started:.2f} с, серверов: {len(guilds)}")
+
+async def warm_up_guild(guild):
+    """Открыть базу, загрузить участников, заполнить кэш имён и отрисовать
+    первые страницы топов; время каждого этапа - в лог и в метрики"""
+    timings = []
+    phase_started = time.perf_counter()
+    
+    def finish_phase(name):
+        nonlocal phase_started
+        now = time.perf_counter()
+        metrics.observe('rating_warmup_seconds', name, now - phase_started)
+        timings.append(f"{name} {now - phase_started:.2f} с")
+        phase_started = now
+    
+    # Рейтинги, индекс топа, хвост истории с индексом и окна строятся при открытии базы;
+    # открывается она в рабочем потоке, чтобы не задерживать команды других серверов
+    db = await asyncio.to_thread(shards.get, guild.id)
+    finish_phase('база')
+    await ensure_members(guild)
+    finish_phase('участники')
+    # После загрузки участников REST-запросы нужны только для тех, кто ушёл с сервера
+    fetched = await names.warm([user_id for user_id, _ in await run_db(db.get_users_page, 0, WARMUP_NAMES)], guild)
+    finish_phase('имена')
+    for window in TOP_TITLES:
+        leaderboard = db.leaderboard if window is None else await run_db(db.get_window_leaderboard, window)
+        if await run_db(len, leaderboard):
+            # Первая страница попадает в общий кэш страниц !топ
+            await TopPaginationView(bot, leaderboard, guild=guild, window=window).create_embed(0)
+    finish_phase('топы')
+    print(f"Прогрев сервера {guild.id}: {', '.join(timings)}; "
+          f"участников: {len(guild.members)}, имён запрошено: {fetched}")
+
+async def format_history(entries, guild=None):
+    """Строки истории изменений с именами модераторов, полученными одним пакетом"""
+    changer_names = await names.resolve_many([entry['changer_id'] for entry in entries], guild)
+    return "".join(format_history_entry(entry, changer_name)
+                   for entry, changer_name in zip(entries, changer_names))
+
+def format_history_entry(entry, changer_name):
+    """Строка истории изменений: время, изменение, кто изменил и комментарий"""
+    
+    timestamp = datetime.fromisoformat(entry['timestamp'])
+    time_str = timestamp.strftime("%d.%m.%Y %H:%M")
+    
+    amount_str = f"+{entry['amount']}" if entry['amount'] > 0 else str(entry['amount'])
+    comment_str = f" - {entry['comment']}" if entry.get('comment') else ""
+    
+    return f"**{time_str}** | {amount_str} **LP** от {changer_name}{comment_str}\n"
 
 @bot.command(name='рейтинг', aliases=['rating', 'р'])
 async def show_rating(ctx, member: discord.Member = None):
@@ -30,33 +259,26 @@ async def show_rating(ctx, member: discord.Member = None):
     if member is None:
         member = ctx.author
     
-    rating = db.get_rating(member.id)
-    history = db.get_rating_history(member.id, limit=5)
+    db = await get_db(ctx)
+    rating, history, rank, total_users = await run_db(lambda: (
+        db.get_rating(member.id),
+        db.get_rating_history(member.id, limit=5),
+        db.get_user_rank(member.id),
+        db.count_users()
+    ))
     
     embed = discord.Embed(
         title=f"Социальный рейтинг {member.display_name}",
         color=discord.Color.gold()
     )
     embed.add_field(name="Рейтинг", value=f"💎 {rating} **LP**", inline=True)
+    if rank is not None:
+        embed.add_field(name="Место", value=f"🏅 место #{rank} из {total_users}", inline=True)
     embed.set_thumbnail(url=member.avatar.url if member.avatar else member.default_avatar.url)
     
     # Добавляем историю изменений
     if history:
-        history_text = ""
-        for entry in history:
-            try:
-                changer = await bot.fetch_user(int(entry['changer_id']))
-                changer_name = changer.display_name
-            except:
-                changer_name = f"Пользователь {entry['changer_id']}"
-            
-            timestamp = datetime.fromisoformat(entry['timestamp'])
-            time_str = timestamp.strftime("%d.%m.%Y %H:%M")
-            
-            amount_str = f"+{entry['amount']}" if entry['amount'] > 0 else str(entry['amount'])
-            comment_str = f" - {entry['comment']}" if entry.get('comment') else ""
-            
-            history_text += f"**{time_str}** | {amount_str} **LP** от {changer_name}{comment_str}\n"
+        history_text = await format_history(history, ctx.guild)
         
         embed.add_field(
             name="📜 Последние изменения",
@@ -85,22 +307,77 @@ def family_only():
         return False
     return commands.check(predicate)
 
-@bot.command(name='добавить', aliases=['add', '+'])
-@family_only()
-async def add_rating(ctx, amount: int, members: commands.Greedy[discord.Member] = None):
-    """Добавить любое количество очков рейтинга (только для модераторов)
-    Формат: !добавить количество @user1 @user2 @user3 [комментарий]"""
-    # Проверка количества очков
-    if amount <= 0:
-        await ctx.send("❌ Количество очков должно быть положительным числом!")
-        return
+# Максимальная длина значения поля embed
+EMBED_FIELD_LIMIT = 1024
+
+async def ensure_members(guild):
+    """Загрузить участников сервера, если их ещё не загрузил прогрев после запуска
+    (при старте участники не загружаются, см. chunk_guilds_at_startup)"""
+    if not guild.chunked:
+        await guild.chunk()
+
+class RoleMention(commands.Converter):
+    """Роль только по упоминанию <@&id>. Стандартный конвертер находит роль и по
+    названию, и слово комментария, совпавшее с названием роли, раздало бы LP
+    всем её участникам"""
+    async def convert(self, ctx, argument):
+        match = re.fullmatch(r'<@&(\d+)>', argument)
+        role = ctx.guild.get_role(int(match.group(1))) if match else None
+        if role is None:
+            raise commands.BadArgument(f"Не упоминание роли: {argument}")
+        return role
+
+def expand_targets(targets):
+    """Участники из упоминаний пользователей и ролей без повторов, и упомянутые роли.
+    Роль раскрывается во всех её участников из кэша сервера, кроме ботов"""
+    members = {}
+    roles = []
+    for target in targets:
+        if isinstance(target, discord.Role):
+            roles.append(target)
+            for member in target.members:
+                if not member.bot:
+                    members.setdefault(member.id, member)
+        else:
+            members.setdefault(target.id, target)
+    return list(members.values()), roles
+
+def add_changes_field(embed, results, change):
+    """Добавить в embed поле «Изменения». Если список не помещается в поле,
+    в нём остаётся начало, а полный список возвращается файлом для вложения"""
+    lines = []
+    for result in results:
+        if result['success']:
+            lines.append(f"**{result['member'].display_name}**: {result['old_rating']} → {result['new_rating']} **LP** ({change})")
+        else:
+            lines.append(f"**{result['member'].display_name}**: ❌ Ошибка")
     
-    # Проверка наличия пользователей
-    if not members:
-        await ctx.send("❌ Укажите хотя бы одного пользователя!\n"
-                      "Формат: `!добавить количество @user1 @user2 [комментарий]`")
-        return
+    # Место под строку «...и ещё N»
+    budget = EMBED_FIELD_LIMIT - 64
+    shown = 0
+    for line in lines:
+        budget -= len(line) + 1
+        if budget < 0:
+            break
+        shown += 1
+    value = "\n".join(lines[:shown])
+    changes_file = None
+    if shown < len(lines):
+        value += f"\n...и ещё {len(lines) - shown}, полный список во вложении"
+        text = "".join(
+            f"{result['member'].display_name} ({result['member'].id}): "
+            + (f"{result['old_rating']} -> {result['new_rating']} ({change})" if result['success'] else "ошибка")
+            + "\n"
+            for result in results
+        )
+        changes_file = discord.File(io.BytesIO(text.encode('utf-8')), filename='rating_changes.txt')
     
+    embed.add_field(name="📊 Изменения", value=value or "Нет изменений", inline=False)
+    return changes_file
+
+def extract_comment(ctx, amount):
+    """Комментарий из текста команды !добавить/!убрать: всё, кроме префикса,
+    названия команды, количества очков и упоминаний пользователей и ролей"""
     # Извлекаем комментарий из оставшегося текста сообщения
     # Используем ctx.message.mentions для более надежного парсинга
     message_content = ctx.message.content
@@ -135,34 +412,73 @@ async def add_rating(ctx, amount: int, members: commands.Greedy[discord.Member]
         ]
         for pattern in mention_patterns:
             processed_comment = processed_comment.replace(pattern, '', 1)
+    for role in ctx.message.role_mentions:
+        processed_comment = processed_comment.replace(role.mention, '', 1)
     
     # Очищаем от лишних пробелов
     processed_comment = ' '.join(processed_comment.split()).strip()
     
-    # Если комментарий пустой, устанавливаем None
-    if not processed_comment:
-        processed_comment = None
+    # Если комментарий пустой, возвращаем None
+    return processed_comment or None
+
+@bot.command(name='добавить', aliases=['add', '+'])
+@family_only()
+async def add_rating(ctx, amount: int, targets: commands.Greedy[typing.Union[discord.Member, RoleMention]] = None):
+    """Добавить любое количество очков рейтинга (только для модераторов)
+    Формат: !добавить количество @user1 @user2 @роль [комментарий]
+    Роль означает всех её участников (кроме ботов)"""
+    # Проверка количества очков
+    if amount <= 0:
+        await ctx.send("❌ Количество очков должно быть положительным числом!")
+        return
     
-    # Применяем изменения ко всем пользователям
-    results = []
-    for member in members:
-        try:
-            old_rating = db.get_rating(member.id)
-            new_rating = db.add_rating(member.id, amount, changer_id=ctx.author.id, comment=processed_comment)
-            results.append({
-                'member': member,
-                'old_rating': old_rating,
-                'new_rating': new_rating,
-                'success': True
-            })
-        except Exception as e:
-            results.append({
-                'member': member,
-                'error': str(e),
-                'success': False
-            })
+    # Проверка наличия пользователей
+    if not targets:
+        await ctx.send("❌ Укажите хотя бы одного пользователя или роль!\n"
+                      "Формат: `!добавить количество @user1 @роль [комментарий]`")
+        return
+    if any(isinstance(target, discord.Role) for target in targets):
+        # Участники роли берутся из кэша - он должен быть полным
+        await ensure_members(ctx.guild)
+    members, roles = expand_targets(targets)
+    if any(role.is_default() for role in roles):
+        await ctx.send("❌ Роль @everyone указать нельзя!")
+        return
+    if not members:
+        await ctx.send("❌ В указанных ролях нет участников!")
+        return
+    
+    processed_comment = extract_comment(ctx, amount)
+    
+    # Применяем изменения ко всем пользователям одной транзакцией
+    db = await get_db(ctx)
+    
+    def apply_changes():
+        with db.transaction() as tx:
+            tx.prefetch(member.id for member in members)
+            for member in members:
+                tx.add_rating(member.id, amount, changer_id=ctx.author.id, comment=processed_comment)
+        return tx
+    
+    try:
+        tx = await run_db(apply_changes)
+        # Значения после сохранения: общее хранилище возвращает свои
+        results = [{
+            'member': member,
+            'old_rating': tx.rating_before(member.id),
+            'new_rating': tx.ratings[str(member.id)],
+            'success': True
+        } for member in members]
+    except Exception as e:
+        # Транзакция не сохранена целиком - изменений нет ни у кого
+        results = [{
+            'member': member,
+            'error': str(e),
+            'success': False
+        } for member in members]
     
     # Создаем embed с результатами
+    changes_file = None
     if len(results) == 1:
         # Один пользователь - используем старый формат для совместимости
         result = results[0]
@@ -193,105 +509,76 @@ async def add_rating(ctx, amount: int, members: commands.Greedy[discord.Member]
             color=discord.Color.green()
         )
         
-        # Добавляем информацию о каждом пользователе
-        users_info = ""
-        for result in results:
-            if result['success']:
-                users_info += f"**{result['member'].display_name}**: {result['old_rating']} → {result['new_rating']} **LP** (+{amount})\n"
-            else:
-                users_info += f"**{result['member'].display_name}**: ❌ Ошибка\n"
-        
-        embed.add_field(
-            name="📊 Изменения",
-            value=users_info if users_info else "Нет изменений",
-            inline=False
-        )
+        if roles:
+            embed.add_field(name="👥 Роли", value=", ".join(role.mention for role in roles)[:EMBED_FIELD_LIMIT], inline=False)
+        # Список изменений; если он не помещается в embed, целиком приходит файлом
+        changes_file = add_changes_field(embed, results, f"+{amount}")
         
         if processed_comment:
             embed.add_field(name="💬 Комментарий", value=processed_comment, inline=False)
         
         embed.set_footer(text=f"Всего обработано: {len(results)} пользователей")
     
-    await ctx.send(embed=embed)
+    await ctx.send(embed=embed, file=changes_file)
 
 @bot.command(name='убрать', aliases=['remove', '-'])
 @family_only()
-async def remove_rating(ctx, amount: int, members: commands.Greedy[discord.Member] = None):
+async def remove_rating(ctx, amount: int, targets: commands.Greedy[typing.Union[discord.Member, RoleMention]] = None):
     """Убрать любое количество очков рейтинга (только для модераторов)
-    Формат: !убрать количество @user1 @user2 @user3 [комментарий]"""
+    Формат: !убрать количество @user1 @user2 @роль [комментарий]
+    Роль означает всех её участников (кроме ботов)"""
     # Проверка количества очков
     if amount <= 0:
         await ctx.send("❌ Количество очков должно быть положительным числом!")
         return
     
     # Проверка наличия пользователей
+    if not targets:
+        await ctx.send("❌ Укажите хотя бы одного пользователя или роль!\n"
+                      "Формат: `!убрать количество @user1 @роль [комментарий]`")
+        return
+    if any(isinstance(target, discord.Role) for target in targets):
+        # Участники роли берутся из кэша - он должен быть полным
+        await ensure_members(ctx.guild)
+    members, roles = expand_targets(targets)
+    if any(role.is_default() for role in roles):
+        await ctx.send("❌ Роль @everyone указать нельзя!")
+        return
     if not members:
-        await ctx.send("❌ Укажите хотя бы одного пользователя!\n"
-                      "Формат: `!убрать количество @user1 @user2 [комментарий]`")
+        await ctx.send("❌ В указанных ролях нет участников!")
         return
     
-    # Извлекаем комментарий из оставшегося текста сообщения
-    # Используем ctx.message.mentions для более надежного парсинга
-    message_content = ctx.message.content
-    command_prefix = ctx.prefix
-    command_name = ctx.invoked_with
+    processed_comment = extract_comment(ctx, amount)
     
-    # Удаляем префикс и название команды
-    args_text = message_content[len(command_prefix) + len(command_name):].strip()
+    # Применяем изменения ко всем пользователям одной транзакцией
+    db = await get_db(ctx)
     
-    # Удаляем количество очков (только первое вхождение)
-    amount_str = str(amount)
-    if args_text.startswith(amount_str):
-        args_text = args_text[len(amount_str):].strip()
-    elif amount_str in args_text:
-        # Если количество не в начале, удаляем первое вхождение
-        idx = args_text.find(amount_str)
-        # Проверяем, что это отдельное число (окружено пробелами или в начале/конце)
-        if idx > 0 and args_text[idx-1] == ' ':
-            args_text = args_text[:idx] + args_text[idx+len(amount_str):].strip()
-        elif idx == 0:
-            args_text = args_text[len(amount_str):].strip()
+    def apply_changes():
+        with db.transaction() as tx:
+            tx.prefetch(member.id for member in members)
+            for member in members:
+                tx.remove_rating(member.id, amount, changer_id=ctx.author.id, comment=processed_comment)
+        return tx
     
-    # Удаляем все упоминания пользователей из текста
-    # Используем упоминания из сообщения для точного удаления
-    processed_comment = args_text
-    for mention in ctx.message.mentions:
-        # Удаляем все варианты упоминания
-        mention_patterns = [
-            f"<@{mention.id}>",
-            f"<@!{mention.id}>",
-            mention.mention
-        ]
-        for pattern in mention_patterns:
-            processed_comment = processed_comment.replace(pattern, '', 1)
-    
-    # Очищаем от лишних пробелов
-    processed_comment = ' '.join(processed_comment.split()).strip()
-    
-    # Если комментарий пустой, устанавливаем None
-    if not processed_comment:
-        processed_comment = None
-    
-    # Применяем изменения ко всем пользователям
-    results = []
-    for member in members:
-        try:
-            old_rating = db.get_rating(member.id)
-            new_rating = db.remove_rating(member.id, amount, changer_id=ctx.author.id, comment=processed_comment)
-            results.append({
-                'member': member,
-                'old_rating': old_rating,
-                'new_rating': new_rating,
-                'success': True
-            })
-        except Exception as e:
-            results.append({
-                'member': member,
-                'error': str(e),
-                'success': False
-            })
+    try:
+        tx = await run_db(apply_changes)
+        # Значения после сохранения: общее хранилище возвращает свои
+        results = [{
+            'member': member,
+            'old_rating': tx.rating_before(member.id),
+            'new_rating': tx.ratings[str(member.id)],
+            'success': True
+        } for member in members]
+    except Exception as e:
+        # Транзакция не сохранена целиком - изменений нет ни у кого
+        results = [{
+            'member': member,
+            'error': str(e),
+            'success': False
+        } for member in members]
     
     # Создаем embed с результатами
+    changes_file = None
     if len(results) == 1:
         # Один пользователь - используем старый формат для совместимости
         result = results[0]
@@ -322,105 +609,455 @@ async def remove_rating(ctx, amount: int, members: commands.Greedy[discord.Membe
             color=discord.Color.orange()
         )
         
-        # Добавляем информацию о каждом пользователе
-        users_info = ""
-        for result in results:
-            if result['success']:
-                users_info += f"**{result['member'].display_name}**: {result['old_rating']} → {result['new_rating']} **LP** (-{amount})\n"
-            else:
-                users_info += f"**{result['member'].display_name}**: ❌ Ошибка\n"
-        
-        embed.add_field(
-            name="📊 Изменения",
-            value=users_info if users_info else "Нет изменений",
-            inline=False
-        )
+        if roles:
+            embed.add_field(name="👥 Роли", value=", ".join(role.mention for role in roles)[:EMBED_FIELD_LIMIT], inline=False)
+        # Список изменений; если он не помещается в embed, целиком приходит файлом
+        changes_file = add_changes_field(embed, results, f"-{amount}")
         
         if processed_comment:
             embed.add_field(name="💬 Комментарий", value=processed_comment, inline=False)
         
         embed.set_footer(text=f"Всего обработано: {len(results)} пользователей")
     
-    await ctx.send(embed=embed)
+    await ctx.send(embed=embed, file=changes_file)
+
+# Ограничения !пакет: строк в сообщении или файле, размер CSV-вложения
+BATCH_MAX_LINES = 500
+BATCH_MAX_ATTACHMENT = 1024 * 1024
+# Строк сводки на странице и ошибок в ответе
+BATCH_LINES_PER_PAGE = 15
+BATCH_ERRORS_SHOWN = 15
+BATCH_USAGE = ("`!пакет` и дальше по строке на изменение: `±количество @user [комментарий]`\n"
+               "или CSV-вложение со столбцами: количество, пользователь (упоминание или id), комментарий")
+# Пользователь - упоминание или id
+USER_REFERENCE = re.compile(r'<@!?(\d+)>|(\d{15,20})')
+BATCH_LINE = re.compile(r'([+-]?\d+)\s+(<@!?\d+>|\d{15,20})(?:\s+(.*))?')
+
+def parse_batch_text(text):
+    """Строки сообщения !пакет -> [(номер строки, количество, пользователь, комментарий)] и ошибки"""
+    items = []
+    errors = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        match = BATCH_LINE.fullmatch(line)
+        if match is None:
+            errors.append(f"строка {line_number}: ожидается `±количество @user [комментарий]`")
+            continue
+        items.append((line_number, match.group(1), match.group(2), match.group(3) or ''))
+    return items, errors
+
+def parse_batch_csv(text):
+    """Строки CSV-вложения -> [(номер строки, количество, пользователь, комментарий)] и ошибки.
+    Первая строка без числа в первом столбце считается заголовком"""
+    items = []
+    errors = []
+    for line_number, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) < 2:
+            errors.append(f"строка {line_number}: нужны хотя бы количество и пользователь")
+            continue
+        if line_number == 1 and not row[0].strip().lstrip('+-').isdigit():
+            continue
+        items.append((line_number, row[0].strip(), row[1].strip(), ','.join(row[2:])))
+    return items, errors
 
-class TopPaginationView(View):
-    def __init__(self, bot, all_users, users_per_page=10, timeout=300):
+def validate_batch(guild, items):
+    """Проверить все строки пакета до применения: количество - ненулевое число,
+    пользователь - участник сервера и не бот. Возвращает изменения
+    [(участник, количество, комментарий)] и ошибки"""
+    changes = []
+    errors = []
+    for line_number, amount_text, user_text, comment in items:
+        try:
+            amount = int(amount_text)
+        except ValueError:
+            errors.append(f"строка {line_number}: «{amount_text}» - не число")
+            continue
+        if amount == 0:
+            errors.append(f"строка {line_number}: количество не может быть нулём")
+            continue
+        match = USER_REFERENCE.fullmatch(user_text)
+        member = guild.get_member(int(match.group(1) or match.group(2))) if match else None
+        if member is None:
+            errors.append(f"строка {line_number}: участник «{user_text}» не найден на сервере")
+            continue
+        if member.bot:
+            errors.append(f"строка {line_number}: {member.display_name} - бот")
+            continue
+        changes.append((member, amount, ' '.join(comment.split()) or None))
+    return changes, errors
+
+class BatchSummaryView(View):
+    """Постраничная сводка применённого пакета изменений"""
+    def __init__(self, results, lines_per_page=BATCH_LINES_PER_PAGE, timeout=300):
+        super().__init__(timeout=timeout)
+        self.lines = []
+        for member, amount, old_rating, new_rating, comment in results:
+            comment_str = f" - {comment[:80]}" if comment else ""
+            self.lines.append(f"**{member.display_name}**: {old_rating} → {new_rating} **LP** ({amount:+d}){comment_str}")
+        self.users = len({member.id for member, *_ in results})
+        self.total = sum(amount for _, amount, *_ in results)
+        self.lines_per_page = lines_per_page
+        self.total_pages = max(1, (len(self.lines) + lines_per_page - 1) // lines_per_page)
+        self.current_page = 0
+    
+    def create_embed(self, page):
+        """Создать embed для указанной страницы"""
+        start = page * self.lines_per_page
+        embed = discord.Embed(
+            title="📦 Пакет изменений применён",
+            description="\n".join(self.lines[start:start + self.lines_per_page]),
+            color=discord.Color.green()
+        )
+        embed.add_field(name="Изменений", value=str(len(self.lines)), inline=True)
+        embed.add_field(name="Пользователей", value=str(self.users), inline=True)
+        embed.add_field(name="Итого", value=f"{self.total:+d} **LP**", inline=True)
+        embed.set_footer(text=f"Страница {page + 1} из {self.total_pages}")
+        return embed
+    
+    @discord.ui.button(label='⬅️', style=discord.ButtonStyle.secondary)
+    async def previous_button(self, interaction: discord.Interaction, button: Button):
+        self.current_page = (self.current_page - 1) % self.total_pages
+        await interaction.response.edit_message(embed=self.create_embed(self.current_page), view=self)
+    
+    @discord.ui.button(label='➡️', style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: Button):
+        self.current_page = (self.current_page + 1) % self.total_pages
+        await interaction.response.edit_message(embed=self.create_embed(self.current_page), view=self)
+    
+    async def on_timeout(self):
+        # Отключаем кнопки при истечении времени
+        for item in self.children:
+            item.disabled = True
+
+@bot.command(name='пакет', aliases=['batch', 'пачка'])
+@family_only()
+async def batch_rating(ctx):
+    """Изменить рейтинг многим пользователям одним сообщением, каждому на своё количество
+    Формат: !пакет и по строке на изменение: ±количество @user [комментарий]
+    (или CSV-вложение: количество, пользователь, комментарий). Строки проверяются
+    все сразу, и если ошибок нет, применяются одной транзакцией"""
+    if ctx.message.attachments:
+        attachment = ctx.message.attachments[0]
+        if attachment.size > BATCH_MAX_ATTACHMENT:
+            await ctx.send(f"❌ Файл больше {BATCH_MAX_ATTACHMENT // 1024} КБ!")
+            return
+        try:
+            text = (await attachment.read()).decode('utf-8-sig')
+        except UnicodeDecodeError:
+            await ctx.send("❌ Файл должен быть в кодировке UTF-8!")
+            return
+        items, errors = parse_batch_csv(text)
+    else:
+        items, errors = parse_batch_text(ctx.message.content[len(ctx.prefix) + len(ctx.invoked_with):])
+    
+    if not items and not errors:
+        await ctx.send(f"❌ Пакет пуст!\nФормат: {BATCH_USAGE}")
+        return
+    if len(items) + len(errors) > BATCH_MAX_LINES:
+        await ctx.send(f"❌ В пакете больше {BATCH_MAX_LINES} строк!")
+        return
+    await ensure_members(ctx.guild)
+    changes, invalid = validate_batch(ctx.guild, items)
+    errors += invalid
+    if errors:
+        shown = "\n".join(errors[:BATCH_ERRORS_SHOWN])
+        if len(errors) > BATCH_ERRORS_SHOWN:
+            shown += f"\n...и ещё {len(errors) - BATCH_ERRORS_SHOWN}"
+        embed = discord.Embed(
+            title="❌ Пакет не применён",
+            description=f"Исправьте ошибки, рейтинг никому не изменён:\n{shown}",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    # Все строки - одна транзакция и одна запись на диск
+    db = await get_db(ctx)
+    
+    def apply_changes():
+        with db.transaction() as tx:
+            tx.prefetch(member.id for member, _, _ in changes)
+            for member, amount, comment in changes:
+                tx.add_rating(member.id, amount, changer_id=ctx.author.id, comment=comment)
+        return tx
+    
+    try:
+        tx = await run_db(apply_changes)
+    except Exception as e:
+        print(f"Ошибка в команде пакета: {e}")
+        await ctx.send("❌ Не удалось сохранить пакет, рейтинг никому не изменён!")
+        return
+    # Строки по порядку от значений, которые вернуло хранилище после сохранения
+    current = {}
+    results = []
+    for member, amount, comment in changes:
+        old_rating = current.get(member.id, tx.rating_before(member.id))
+        current[member.id] = old_rating + amount
+        results.append((member, amount, old_rating, current[member.id], comment))
+    
+    view = BatchSummaryView(results)
+    if view.total_pages > 1:
+        await ctx.send(embed=view.create_embed(0), view=view)
+    else:
+        await ctx.send(embed=view.create_embed(0))
+
+# Сколько ждать полную страницу, прежде чем показать быструю (ответ на нажатие - не позже 3 секунд)
+QUICK_PAGE_DELAY = 0.3
+
+class DeferredPageView(View):
+    """Вид с кнопками страниц, который отвечает на нажатие сразу.
+
+    Если полная страница (create_embed) не готова за QUICK_PAGE_DELAY секунд,
+    сообщение правится быстрой страницей (quick_embed: имена только из кэшей),
+    а полная подставляется, когда будет готова. Каждое нажатие получает номер:
+    новое нажатие сразу отменяет недорисованную страницу, а страница старого
+    нажатия никогда не показывается поверх новой."""
+    def __init__(self, timeout=300):
+        super().__init__(timeout=timeout)
+        self.current_page = 0
+        self._generation = 0
+        self._pending = None
+        self._render_task = None
+    
+    async def create_embed(self, page):
+        raise NotImplementedError
+    
+    async def quick_embed(self, page):
+        raise NotImplementedError
+    
+    def _cancel_render(self):
+        for task in (self._render_task, self._pending):
+            if task is not None:
+                task.cancel()
+        self._render_task = None
+        self._pending = None
+    
+    async def show_page(self, interaction, page):
+        self.current_page = page
+        self._generation += 1
+        generation = self._generation
+        self._cancel_render()
+        render = self._pending = asyncio.ensure_future(self.create_embed(page))
+        # asyncio.wait не отменяет отрисовку по таймауту и не бросает её ошибку
+        await asyncio.wait({render}, timeout=QUICK_PAGE_DELAY)
+        if generation != self._generation:
+            # Пока страница рисовалась, пришло новое нажатие - показывать будет оно
+            await interaction.response.defer()
+            return
+        
+        if render.done():
+            self._pending = None
+            if render.cancelled() or render.exception() is not None:
+                if not render.cancelled():
+                    print(f"Ошибка отрисовки страницы: {render.exception()}")
+                await interaction.response.defer()
+                return
+            await interaction.response.edit_message(embed=render.result(), view=self)
+            return
+        # Быстрая страница тоже читает базу (у общего хранилища - через сокет)
+        try:
+            quick = await self.quick_embed(page)
+        except Exception as e:
+            print(f"Ошибка отрисовки страницы: {e}")
+            quick = None
+        if generation != self._generation:
+            await interaction.response.defer()
+            return
+        if quick is None:
+            await interaction.response.defer()
+        else:
+            await interaction.response.edit_message(embed=quick, view=self)
+        if generation == self._generation:
+            self._render_task = asyncio.ensure_future(self._finish_page(interaction, render, generation))
+    
+    async def _finish_page(self, interaction, render, generation):
+        try:
+            embed = await render
+            if generation != self._generation:
+                return
+            await interaction.edit_original_response(embed=embed, view=self)
+        except asyncio.CancelledError:
+            render.cancel()
+            raise
+        except Exception as e:
+            print(f"Ошибка отрисовки страницы: {e}")
+    
+    async def on_timeout(self):
+        # Отключаем кнопки при истечении времени
+        for item in self.children:
+            item.disabled = True
+        self._cancel_render()
+
+class PageCache:
+    """Готовые embed страниц топа, общие для всех открытых !топ.
+
+    Ключ включает версию лидерборда, поэтому после любого изменения рейтинга
+    старые страницы просто перестают запрашиваться и вытесняются по LRU.
+    Хранятся задачи отрисовки: одновременные запросы одной страницы ждут одну задачу"""
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def _task(self, key, render):
+        task = self._pages.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = asyncio.ensure_future(render())
+            # Ошибка отрисовки достанется тому, кто ждёт страницу; для предзагрузки - гасим
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._pages[key] = task
+            created = True
+        else:
+            created = False
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_size:
+            self._pages.popitem(last=False)
+        return task, created
+    
+    def get(self, key, render):
+        """Ожидаемый embed страницы (из кэша или после отрисовки)"""
+        task, created = self._task(key, render)
+        if created:
+            self.misses += 1
+        else:
+            self.hits += 1
+        # shield: отмена одного ожидающего не отменяет общую отрисовку
+        return asyncio.shield(task)
+    
+    def prefetch(self, key, render):
+        """Отрисовать страницу в фоне, если её ещё нет в кэше"""
+        self._task(key, render)
+
+top_page_cache = PageCache()
+
+# Периоды !топ: слово в команде -> окно базы (см. windows.py) и заголовок
+TOP_PERIODS = {
+    'день': 'day', 'сегодня': 'day', 'day': 'day',
+    'неделя': 'week', 'week': 'week',
+    'месяц': 'month', 'month': 'month'
+}
+TOP_TITLES = {
+    None: "🏆 Топ пользователей по **Libero points**",
+    'day': "🏆 Топ за сегодня по **Libero points**",
+    'week': "🏆 Топ за неделю по **Libero points**",
+    'month': "🏆 Топ за месяц по **Libero points**"
+}
+
+class TopPeriod(commands.Converter):
+    """Период топа (день, неделя, месяц) -> название окна"""
+    async def convert(self, ctx, argument):
+        window = TOP_PERIODS.get(argument.lower())
+        if window is None:
+            raise commands.BadArgument(f"Неизвестный период: {argument}")
+        return window
+
+class TopPaginationView(DeferredPageView):
+    """Топ по страницам. Вид не хранит список пользователей: страницы читаются
+    из лидерборда по запросу, а число страниц пересчитывается при каждом показе.
+    С pin=True топ фиксируется на версии открытия (снимок почти бесплатен,
+    пока рейтинг не меняется). window - окно топа за период (None - за всё время)"""
+    def __init__(self, bot, leaderboard, users_per_page=10, timeout=300, guild=None, pin=False, window=None):
         super().__init__(timeout=timeout)
         self.bot = bot
-        self.all_users = all_users
+        self.guild = guild
+        self.window = window
+        self.leaderboard = leaderboard.snapshot() if pin else leaderboard
         self.users_per_page = users_per_page
-        self.current_page = 0
-        self.total_pages = (len(all_users) + users_per_page - 1) // users_per_page if all_users else 1
+        # Число страниц по последнему прочитанному состоянию топа (для кнопок)
+        self.total_pages = 1
+    
+    def _page_key(self, page, version):
+        guild_id = self.guild.id if self.guild is not None else None
+        return (guild_id, self.window, version, self.users_per_page, page)
+    
+    async def _read_page(self, page):
+        """Версия топа, номер страницы (не дальше последней) и её строки.
+        Версия, размер и страница читаются одним запросом, поэтому содержимое
+        совпадает с версией в ключе кэша"""
+        n = self.users_per_page
+        version, users, page_users = await run_db(self.leaderboard.read_page, page * n, n)
+        self.total_pages = max(1, (users + n - 1) // n)
+        if page >= self.total_pages:
+            page = self.total_pages - 1
+            version, users, page_users = await run_db(self.leaderboard.read_page, page * n, n)
+        return version, page, page_users
+    
+    async def _prefetch(self, page):
+        version, page, page_users = await self._read_page(page)
+        return await self.render_embed(page, page_users, self.total_pages, background=True)
     
     async def create_embed(self, page):
-        """Создать embed для указанной страницы"""
+        """Получить embed страницы из кэша и заранее отрисовать соседние"""
+        version, page, page_users = await self._read_page(page)
+        total_pages = self.total_pages
+        embed = await top_page_cache.get(
+            self._page_key(page, version),
+            lambda: self.render_embed(page, page_users, total_pages)
+        )
+        for neighbour in ((page - 1) % total_pages, (page + 1) % total_pages):
+            # Соседняя страница читается позже и может оказаться новее версии в ключе:
+            # такая запись кэша просто не будет запрошена после следующего изменения
+            top_page_cache.prefetch(self._page_key(neighbour, version), lambda neighbour=neighbour: self._prefetch(neighbour))
+        return embed
+    
+    async def quick_embed(self, page):
+        """Страница с именами только из кэшей (остальные - id), без запросов к API"""
+        version, page, page_users = await self._read_page(page)
+        total_pages = self.total_pages
+        usernames = names.resolve_cached([user_id for user_id, _ in page_users], self.guild)
+        embed = self.build_embed(page, page_users, total_pages, usernames)
+        if page_users:
+            embed.set_footer(text=f"Страница {page + 1} из {total_pages} · загружаю имена...")
+        return embed
+    
+    async def render_embed(self, page, page_users, total_pages, background=False):
+        """Создать embed для указанной страницы (background - предзагрузка: имена
+        запрашиваются после тех, которых ждут пользователи)"""
+        usernames = await names.resolve_many([user_id for user_id, _ in page_users], self.guild, background)
+        return self.build_embed(page, page_users, total_pages, usernames)
+    
+    def build_embed(self, page, page_users, total_pages, usernames):
         start_idx = page * self.users_per_page
-        end_idx = start_idx + self.users_per_page
-        page_users = self.all_users[start_idx:end_idx]
         
         embed = discord.Embed(
-            title="🏆 Топ пользователей по **Libero points**",
+            title=TOP_TITLES[self.window],
             color=discord.Color.purple()
         )
         
         if not page_users:
-            embed.description = "Пока никто не имеет **LP**!"
+            embed.description = "Пока никто не имеет **LP**!" if self.window is None else "За этот период изменений не было"
             return embed
         
-        for i, (user_id, rating) in enumerate(page_users, start=start_idx + 1):
-            try:
-                user = await self.bot.fetch_user(int(user_id))
-                username = user.display_name
-            except:
-                username = f"Пользователь {user_id}"
-            
+        for i, ((user_id, rating), username) in enumerate(zip(page_users, usernames), start=start_idx + 1):
             medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
             embed.add_field(
                 name=f"{medal} {username}",
-                value=f"💎 {rating}  **LP**",
+                # За период показывается изменение, а не итоговый рейтинг
+                value=f"💎 {rating}  **LP**" if self.window is None else f"📈 {rating:+d}  **LP**",
                 inline=False
             )
         
-        embed.set_footer(text=f"Страница {page + 1} из {self.total_pages}")
+        embed.set_footer(text=f"Страница {page + 1} из {total_pages}")
         return embed
     
     @discord.ui.button(label='⬅️', style=discord.ButtonStyle.secondary)
     async def previous_button(self, interaction: discord.Interaction, button: Button):
-        if self.current_page > 0:
-            self.current_page -= 1
-        else:
-            self.current_page = self.total_pages - 1
-        
-        try:
-            embed = await self.create_embed(self.current_page)
-            await interaction.response.edit_message(embed=embed, view=self)
-        except Exception as e:
-            if not interaction.response.is_done():
-                await interaction.response.defer()
+        await self.show_page(interaction, (self.current_page - 1) % self.total_pages)
     
     @discord.ui.button(label='➡️', style=discord.ButtonStyle.secondary)
     async def next_button(self, interaction: discord.Interaction, button: Button):
-        if self.current_page < self.total_pages - 1:
-            self.current_page += 1
-        else:
-            self.current_page = 0
-        
-        try:
-            embed = await self.create_embed(self.current_page)
-            await interaction.response.edit_message(embed=embed, view=self)
-        except Exception as e:
-            if not interaction.response.is_done():
-                await interaction.response.defer()
-    
-    async def on_timeout(self):
-        # Отключаем кнопки при истечении времени
-        for item in self.children:
-            item.disabled = True
+        await self.show_page(interaction, (self.current_page + 1) % self.total_pages)
 
 @bot.command(name='топ', aliases=['top', 'лидеры'])
-async def show_top(ctx, limit: int = None, page: int = None):
+async def show_top(ctx, window: typing.Optional[TopPeriod] = None, limit: int = None, page: int = None):
     """Показать топ пользователей по рейтингу с пагинацией
-    Формат: !топ [лимит] [страница] или !топ [страница]"""
+    Формат: !топ [неделя|месяц|день] [лимит] [страница] или !топ [страница]
+    С периодом топ строится по сумме изменений за последние 7/30 дней или за сегодня"""
     # Определяем параметры: если первый аргумент <= 20, это лимит, иначе страница
     users_per_page = 10
     current_page = 0
@@ -445,20 +1082,16 @@ async def show_top(ctx, limit: int = None, page: int = None):
     if current_page < 0:
         current_page = 0
     
-    all_users = db.get_all_users_sorted()
-    
-    if not all_users:
-        await ctx.send("Пока никто не имеет **LP**!")
+    db = await get_db(ctx)
+    leaderboard = db.leaderboard if window is None else await run_db(db.get_window_leaderboard, window)
+    if not await run_db(len, leaderboard):
+        await ctx.send("Пока никто не имеет **LP**!" if window is None else "За этот период изменений не было")
         return
     
-    total_pages = (len(all_users) + users_per_page - 1) // users_per_page
-    if current_page >= total_pages:
-        current_page = total_pages - 1
-    
-    view = TopPaginationView(ctx.bot, all_users, users_per_page)
-    view.current_page = current_page
-    
+    view = TopPaginationView(ctx.bot, leaderboard, users_per_page, guild=ctx.guild, window=window)
+    # Страница за концом топа показывается последней
     embed = await view.create_embed(current_page)
+    view.current_page = min(current_page, view.total_pages - 1)
     await ctx.send(embed=embed, view=view)
 
 @bot.command(name='мойрейтинг', aliases=['myrating', 'mr'])
@@ -474,7 +1107,8 @@ async def show_bottom(ctx, limit: int = 10):
     if limit < 1:
         limit = 10
     
-    bottom_users = db.get_bottom_users(limit)
+    db = await get_db(ctx)
+    bottom_users = await run_db(db.get_bottom_users, limit)
     
     if not bottom_users:
         await ctx.send("Пока никто не имеет **LP**!")
@@ -485,13 +1119,8 @@ async def show_bottom(ctx, limit: int = 10):
         color=discord.Color.red()
     )
     
-    for i, (user_id, rating) in enumerate(bottom_users, 1):
-        try:
-            user = await bot.fetch_user(int(user_id))
-            username = user.display_name
-        except:
-            username = f"Пользователь {user_id}"
-        
+    usernames = await names.resolve_many([user_id for user_id, _ in bottom_users], ctx.guild)
+    for i, ((user_id, rating), username) in enumerate(zip(bottom_users, usernames), 1):
         # Обратная нумерация для антитопа
         position = len(bottom_users) - i + 1
         medal = "🔻" if i == 1 else f"{position}."
@@ -503,6 +1132,327 @@ async def show_bottom(ctx, limit: int = 10):
     
     await ctx.send(embed=embed)
 
+class HistoryPaginationView(DeferredPageView):
+    """Постраничный просмотр всей истории изменений рейтинга пользователя.
+    Страницы читаются из базы по запросу, старые сегменты истории - только при необходимости"""
+    def __init__(self, db, member, entries_per_page=10, timeout=300):
+        super().__init__(timeout=timeout)
+        self.db = db
+        self.member = member
+        self.entries_per_page = entries_per_page
+        # Число страниц по последнему прочитанному размеру истории (для кнопок)
+        self.total_pages = 1
+    
+    def _read_page(self, page):
+        """Число страниц, номер страницы (не дальше последней) и её записи"""
+        total = self.db.count_rating_history(self.member.id)
+        total_pages = max(1, (total + self.entries_per_page - 1) // self.entries_per_page)
+        page = min(page, total_pages - 1)
+        entries = self.db.get_rating_history(
+            self.member.id,
+            limit=self.entries_per_page,
+            offset=page * self.entries_per_page
+        )
+        return total_pages, page, entries
+    
+    async def _page_entries(self, page):
+        self.total_pages, page, entries = await run_db(self._read_page, page)
+        return page, entries
+    
+    def build_embed(self, page, entries, description):
+        embed = discord.Embed(
+            title=f"📜 История рейтинга {self.member.display_name}",
+            color=discord.Color.gold()
+        )
+        
+        if not entries:
+            embed.description = "История изменений пуста"
+            return embed
+        
+        embed.description = description
+        
+        embed.set_footer(text=f"Страница {page + 1} из {self.total_pages}")
+        return embed
+    
+    async def create_embed(self, page):
+        """Создать embed для указанной страницы"""
+        page, entries = await self._page_entries(page)
+        return self.build_embed(page, entries, await format_history(entries, self.member.guild) if entries else None)
+    
+    async def quick_embed(self, page):
+        """Страница с именами модераторов только из кэшей, без запросов к API"""
+        page, entries = await self._page_entries(page)
+        changer_names = names.resolve_cached([entry['changer_id'] for entry in entries], self.member.guild)
+        embed = self.build_embed(page, entries, "".join(
+            format_history_entry(entry, changer_name) for entry, changer_name in zip(entries, changer_names)))
+        if entries:
+            embed.set_footer(text=f"Страница {page + 1} из {self.total_pages} · загружаю имена...")
+        return embed
+    
+    @discord.ui.button(label='⬅️', style=discord.ButtonStyle.secondary)
+    async def previous_button(self, interaction: discord.Interaction, button: Button):
+        await self.show_page(interaction, (self.current_page - 1) % self.total_pages)
+    
+    @discord.ui.button(label='➡️', style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: Button):
+        await self.show_page(interaction, (self.current_page + 1) % self.total_pages)
+
+@bot.command(name='история', aliases=['history', 'ист'])
+async def show_history(ctx, member: discord.Member = None, page: int = 1):
+    """Показать всю историю изменений рейтинга пользователя по страницам
+    Формат: !история [@user] [страница]"""
+    if member is None:
+        member = ctx.author
+    
+    view = HistoryPaginationView(await get_db(ctx), member)
+    # Страница за концом истории показывается последней
+    embed = await view.create_embed(max(page - 1, 0))
+    view.current_page = min(max(page - 1, 0), view.total_pages - 1)
+    await ctx.send(embed=embed, view=view)
+
+# Заголовки !аудит по периодам (окна те же, что у !топ)
+AUDIT_PERIODS = {
+    None: "за всё время",
+    'day': "за сегодня",
+    'week': "за неделю",
+    'month': "за месяц"
+}
+
+class AuditPaginationView(DeferredPageView):
+    """Сводка !аудит по страницам: модераторы или пользователи одного модератора.
+    Строки посчитаны заранее из сводки базы, по страницам подгружаются только имена"""
+    def __init__(self, rows, guild, moderator=None, window=None, rows_per_page=10, timeout=300):
+        super().__init__(timeout=timeout)
+        self.rows = rows
+        self.guild = guild
+        self.moderator = moderator
+        self.window = window
+        self.rows_per_page = rows_per_page
+    
+    @property
+    def total_pages(self):
+        return max(1, (len(self.rows) + self.rows_per_page - 1) // self.rows_per_page)
+    
+    def _page_rows(self, page):
+        start_idx = page * self.rows_per_page
+        return self.rows[start_idx:start_idx + self.rows_per_page]
+    
+    def build_embed(self, page, page_rows, usernames):
+        period = AUDIT_PERIODS[self.window]
+        if self.moderator is None:
+            title = f"🔍 Аудит модераторов {period}"
+        else:
+            title = f"🔍 Аудит {self.moderator.display_name} {period}"
+        embed = discord.Embed(title=title, color=discord.Color.dark_teal())
+        
+        if not page_rows:
+            embed.description = "За этот период изменений не было"
+            return embed
+        
+        lines = []
+        for i, (row, username) in enumerate(zip(page_rows, usernames), start=page * self.rows_per_page + 1):
+            _, given, removed, changes, *targets = row
+            line = f"**{i}. {username}** — +{given} / -{removed} **LP** · изменений: {changes}"
+            if targets:
+                line += f" · пользователей: {targets[0]}"
+            lines.append(line)
+        embed.description = "\n".join(lines)
+        
+        if self.moderator is not None:
+            given = sum(row[1] for row in self.rows)
+            removed = sum(row[2] for row in self.rows)
+            changes = sum(row[3] for row in self.rows)
+            embed.add_field(name="Всего", value=f"+{given} / -{removed} **LP** · изменений: {changes}", inline=False)
+        
+        embed.set_footer(text=f"Страница {page + 1} из {self.total_pages}")
+        return embed
+    
+    async def create_embed(self, page):
+        """Создать embed для указанной страницы"""
+        page_rows = self._page_rows(page)
+        usernames = await names.resolve_many([row[0] for row in page_rows], self.guild)
+        return self.build_embed(page, page_rows, usernames)
+    
+    async def quick_embed(self, page):
+        """Страница с именами только из кэшей, без запросов к API"""
+        page_rows = self._page_rows(page)
+        usernames = names.resolve_cached([row[0] for row in page_rows], self.guild)
+        embed = self.build_embed(page, page_rows, usernames)
+        if page_rows:
+            embed.set_footer(text=f"Страница {page + 1} из {self.total_pages} · загружаю имена...")
+        return embed
+    
+    @discord.ui.button(label='⬅️', style=discord.ButtonStyle.secondary)
+    async def previous_button(self, interaction: discord.Interaction, button: Button):
+        await self.show_page(interaction, (self.current_page - 1) % self.total_pages)
+    
+    @discord.ui.button(label='➡️', style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: Button):
+        await self.show_page(interaction, (self.current_page + 1) % self.total_pages)
+
+@bot.command(name='аудит', aliases=['audit'])
+@family_only()
+async def show_audit(ctx, moderator: typing.Optional[discord.Member] = None, window: typing.Optional[TopPeriod] = None):
+    """Кто из модераторов сколько LP выдал и снял, кому и сколько раз
+    Формат: !аудит [@модератор] [день|неделя|месяц]
+    Без модератора - сводка по всем, с модератором - по пользователям, которым он менял рейтинг.
+    Ответ строится из сводки, которая обновляется при каждой записи истории"""
+    db = await get_db(ctx)
+    pairs = await run_db(db.get_audit, window)
+    if moderator is None:
+        rows = summarize_moderators(pairs)
+    else:
+        rows = summarize_targets(pairs, moderator.id)
+    
+    view = AuditPaginationView(rows, ctx.guild, moderator=moderator, window=window)
+    embed = await view.create_embed(0)
+    await ctx.send(embed=embed, view=view)
+
+# Строк на раздел в !статистика (поле embed - не больше 1024 символов)
+STATS_LINES = 8
+
+def format_seconds(seconds):
+    return "∞" if seconds == float('inf') else f"{seconds * 1000:g} мс"
+
+def format_histogram(histogram):
+    """Число вызовов и верхние границы p50/p99 по корзинам гистограммы"""
+    return (f"{histogram.count} × p50 ≤{format_seconds(histogram.quantile(0.5))}, "
+            f"p99 ≤{format_seconds(histogram.quantile(0.99))}")
+
+@bot.command(name='статистика', aliases=['stats', 'статы'])
+@family_only()
+async def show_stats(ctx):
+    """Показать метрики бота: задержки команд и базы, запись на диск, запросы имён"""
+    uptime = int(time.time() - metrics.started_at)
+    embed = discord.Embed(
+        title="📊 Статистика бота",
+        description=f"Работает {uptime // 3600} ч {uptime % 3600 // 60} мин, "
+                    f"загружено серверов: {len(shards.loaded_guilds())}",
+        color=discord.Color.blue()
+    )
+    users, entries = await run_db(lambda: (
+        sum(len(db.leaderboard) for db in shards),
+        sum(db.storage.count_history() for db in shards)
+    ))
+    embed.add_field(name="Пользователей с LP", value=str(users), inline=True)
+    embed.add_field(name="Записей истории", value=str(entries), inline=True)
+    embed.add_field(name="Кэш страниц топа",
+                    value=f"{top_page_cache.hits} попаданий / {top_page_cache.misses} промахов", inline=True)
+    
+    sections = (
+        ("⌨️ Команды", 'rating_command_seconds'),
+        ("🗄️ Операции базы", 'rating_db_seconds'),
+        ("💾 Запись на диск", 'rating_flush_seconds'),
+        ("🌐 fetch_user", 'rating_fetch_user_seconds')
+    )
+    for title, family in sections:
+        lines = [f"`{name}`: {format_histogram(histogram)}"
+                 for name, histogram in list(metrics.family(family).items())[:STATS_LINES]]
+        embed.add_field(name=title, value="\n".join(lines) or "Нет данных", inline=False)
+    
+    written = [f"`{name}`: в среднем {histogram.total / histogram.count / 1024:.1f} КБ за запись"
+               for name, histogram in metrics.family('rating_flush_bytes').items() if histogram.count]
+    if written:
+        embed.add_field(name="📦 Объём записи", value="\n".join(written), inline=False)
+    
+    stats = names.stats
+    embed.add_field(
+        name="👤 Имена",
+        value=f"участники: {stats['member_hits']}, пользователи: {stats['user_hits']}, "
+              f"кэш: {stats['cache_hits']}, REST: {stats['misses']}, ошибки: {stats['failures']}, "
+              f"таймауты: {stats['timeouts']}, лимит: {stats['rate_limited']}",
+        inline=False
+    )
+    errors = [f"`{name}`: {count}" for (family, name), count in sorted(metrics.counters.items())
+              if family == 'rating_command_errors']
+    if errors:
+        embed.add_field(name="❌ Ошибки команд", value=", ".join(errors)[:EMBED_FIELD_LIMIT], inline=False)
+    
+    await ctx.send(embed=embed)
+
+EXPORT_KINDS = {
+    'рейтинг': ('ratings',), 'ratings': ('ratings',),
+    'история': ('history',), 'history': ('history',),
+    'всё': ('ratings', 'history'), 'все': ('ratings', 'history'), 'all': ('ratings', 'history')
+}
+EXPORT_USAGE = "`!экспорт [рейтинг|история|всё] [csv|jsonl] [@user] [с ДД.ММ.ГГГГ] [по ДД.ММ.ГГГГ]`"
+# Сколько вложений Discord принимает в одном сообщении
+ATTACHMENTS_PER_MESSAGE = 10
+
+def parse_export_date(text):
+    for date_format in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f"Неверная дата: {text}")
+
+def parse_export_options(options):
+    """Что выгружать, формат и границы [since, until) в ISO из слов команды.
+    Даты - после «с»/«по» или просто по порядку: первая - начало, вторая - конец"""
+    kinds, fmt, dates = ('ratings', 'history'), 'csv', {}
+    expected = None
+    for option in options:
+        word = option.lower()
+        if word in EXPORT_KINDS:
+            kinds = EXPORT_KINDS[word]
+        elif word in FORMATS:
+            fmt = word
+        elif word in ('с', 'от', 'from', 'по', 'до', 'to'):
+            expected = 'since' if word in ('с', 'от', 'from') else 'until'
+        elif re.fullmatch(r'<@!?\d+>', option):
+            continue
+        else:
+            date = parse_export_date(option)
+            dates[expected or ('since' if 'since' not in dates else 'until')] = date
+            expected = None
+    since = dates['since'].isoformat() if 'since' in dates else None
+    # Конечный день входит в выгрузку целиком
+    until = (dates['until'] + timedelta(days=1)).isoformat() if 'until' in dates else None
+    return kinds, fmt, since, until
+
+@bot.command(name='экспорт', aliases=['export', 'выгрузка'])
+@family_only()
+@commands.max_concurrency(1, commands.BucketType.guild)
+async def export_data(ctx, *options):
+    """Выгрузить рейтинги (с местом и именем) и историю изменений сжатыми файлами CSV или JSONL"""
+    try:
+        kinds, fmt, since, until = parse_export_options(options)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}\nФормат: {EXPORT_USAGE}")
+        return
+    member = ctx.message.mentions[0] if ctx.message.mentions else None
+    db = await get_db(ctx)
+    
+    def open_export():
+        ratings = history = None
+        if 'ratings' in kinds:
+            if member is None:
+                ratings = db.iter_ratings()
+            else:
+                rank = db.get_user_rank(member.id)
+                ratings = [(rank, member.id, db.get_rating(member.id))] if rank is not None else []
+        if 'history' in kinds:
+            history = db.iter_history(since, until, member.id if member else None)
+        return ratings, history
+    
+    ratings, history = await run_db(open_export)
+    status = await ctx.send("⏳ Готовлю выгрузку...")
+    # Файлы пишутся на диск в рабочем потоке по мере чтения из базы, целиком в памяти выгрузки нет
+    with tempfile.TemporaryDirectory(prefix='rating-export-') as directory:
+        paths, counts = await asyncio.to_thread(
+            write_export, directory, fmt, ctx.guild.filesize_limit,
+            names.snapshot(ctx.guild), ratings, history
+        )
+        summary = ", ".join(f"{'рейтинги' if kind == 'ratings' else 'история'}: {count} строк"
+                            for kind, count in counts.items())
+        if not paths:
+            await status.edit(content=f"📭 Нечего выгружать ({summary})")
+            return
+        for start in range(0, len(paths), ATTACHMENTS_PER_MESSAGE):
+            await ctx.send(files=[discord.File(path) for path in paths[start:start + ATTACHMENTS_PER_MESSAGE]])
+    await status.edit(content=f"📦 Выгрузка готова ({summary}), файлов: {len(paths)}")
+
 # Обработка ошибок
 @add_rating.error
 @remove_rating.error
@@ -510,12 +1460,12 @@ async def rating_command_error(ctx, error):
     if isinstance(error, commands.MissingRequiredArgument):
         command_name = ctx.command.name
         await ctx.send(f"❌ Укажите количество очков и хотя бы одного пользователя!\n"
-                      f"Формат: `!{command_name} количество @user1 @user2 [комментарий]`")
+                      f"Формат: `!{command_name} количество @user1 @роль [комментарий]`")
     elif isinstance(error, commands.BadArgument):
         command_name = ctx.command.name
         await ctx.send(f"❌ Неверный формат команды!\n"
-                      f"Формат: `!{command_name} количество @user1 @user2 [комментарий]`\n"
-                      f"Пример: `!{command_name} 10 @user1 @user2 За хорошую работу`")
+                      f"Формат: `!{command_name} количество @user1 @роль [комментарий]`\n"
+                      f"Пример: `!{command_name} 10 @user1 @команда За хорошую работу`")
     elif isinstance(error, commands.CommandOnCooldown):
         await ctx.send(f"❌ Команда на перезарядке! Попробуйте через {error.retry_after:.1f} секунд.")
     else:
@@ -526,6 +1476,11 @@ async def rating_show_error(ctx, error):
     if isinstance(error, commands.BadArgument):
         await ctx.send("❌ Пользователь не найден!")
 
+@show_history.error
+async def history_error(ctx, error):
+    if isinstance(error, commands.BadArgument):
+        await ctx.send("❌ Неверный формат! Используйте: `!история [@user] [страница]`")
+
 @show_bottom.error
 async def bottom_error(ctx, error):
     if isinstance(error, commands.BadArgument):
@@ -534,12 +1489,23 @@ async def bottom_error(ctx, error):
 @show_top.error
 async def top_error(ctx, error):
     if isinstance(error, commands.BadArgument):
-        await ctx.send("❌ Неверный формат! Используйте: `!топ [лимит] [страница]`")
+        await ctx.send("❌ Неверный формат! Используйте: `!топ [неделя|месяц] [лимит] [страница]`")
+
+@show_audit.error
+async def audit_error(ctx, error):
+    if isinstance(error, commands.BadArgument):
+        await ctx.send("❌ Неверный формат! Используйте: `!аудит [@модератор] [день|неделя|месяц]`")
+
+@export_data.error
+async def export_error(ctx, error):
+    if isinstance(error, commands.MaxConcurrencyReached):
+        await ctx.send("⏳ Выгрузка для этого сервера уже идёт, дождитесь её окончания")
 
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
         return
+    metrics.increment('rating_command_errors', ctx.command.qualified_name if ctx.command else 'unknown')
     if isinstance(error, commands.CommandOnCooldown):
         return
     print(f"Ошибка: {error}")
@@ -548,6 +1514,10 @@ async def on_command_error(ctx, error):
 if __name__ == "__main__":
     token = os.getenv('DISCORD_TOKEN')
     if token:
-        bot.run(token)
+        try:
+            bot.run(token)
+        finally:
+            # Принудительно сохраняем всё, что не успела записать фоновая запись
+            shards.close()
     else:
         print("Ошибка: DISCORD_TOKEN не найден в .env файле")
\ No newline at end of file
@@ -0,0 +1,156 @@
+import asyncio
+import functools
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Границы корзин гистограмм: задержки в секундах и размеры записей в байтах
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+class Histogram:
+    """Число наблюдений по корзинам; последняя корзина - всё, что больше границ"""
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+    
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает q-квантиль (inf - за пределами)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Счётчики и гистограммы бота в памяти.
+
+    Ключ метрики - (семейство, имя), например ('rating_db_seconds', 'get_rating').
+    Блокировок нет: обновление - несколько операций со списком и числами,
+    поэтому запись из рабочего потока одновременно с циклом событий в худшем
+    случае теряет одно наблюдение. Значения gauge вычисляются при чтении."""
+    def __init__(self):
+        self.started_at = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+    
+    def histogram(self, family, name, buckets=LATENCY_BUCKETS):
+        histogram = self.histograms.get((family, name))
+        if histogram is None:
+            # setdefault атомарен: при гонке обе стороны получат одну гистограмму
+            histogram = self.histograms.setdefault((family, name), Histogram(buckets))
+        return histogram
+    
+    def observe(self, family, name, value, buckets=LATENCY_BUCKETS):
+        self.histogram(family, name, buckets).observe(value)
+    
+    def increment(self, family, name, amount=1):
+        key = (family, name)
+        self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def gauge(self, family, callback):
+        """Значение, которое считается при каждом чтении метрик"""
+        self.gauges[family] = callback
+    
+    @contextmanager
+    def timer(self, family, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(family, name, time.perf_counter() - started)
+    
+    def timed(self, family, name=None):
+        """Декоратор: время выполнения функции в гистограмму (family, имя функции)"""
+        def decorator(func):
+            histogram_name = name or func.__name__
+            
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(family, histogram_name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+    
+    def family(self, family):
+        """Гистограммы семейства {имя: Histogram}, отсортированные по числу наблюдений"""
+        items = [(name, histogram) for (f, name), histogram in list(self.histograms.items()) if f == family]
+        return dict(sorted(items, key=lambda item: -item[1].count))
+    
+    def render_text(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = [f"rating_uptime_seconds {time.time() - self.started_at:.0f}"]
+        for family, callback in list(self.gauges.items()):
+            try:
+                lines.append(f"{family} {callback()}")
+            except Exception as e:
+                lines.append(f"# {family}: {e}")
+        for (family, name), value in sorted(list(self.counters.items())):
+            lines.append(f'{family}{{name="{name}"}} {value}')
+        for (family, name), histogram in sorted(list(self.histograms.items())):
+            seen = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                seen += count
+                lines.append(f'{family}_bucket{{name="{name}",le="{bound:g}"}} {seen}')
+            lines.append(f'{family}_bucket{{name="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{family}_sum{{name="{name}"}} {histogram.total:g}')
+            lines.append(f'{family}_count{{name="{name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+    
+    def write_file(self, path):
+        """Атомарно записать метрики в текстовый файл"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render_text())
+        os.replace(tmp_path, path)
+
+async def dump_periodically(registry, path, interval=60):
+    """Раз в interval секунд записывать метрики в файл (запись - в пуле потоков)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, registry.write_file, path)
+        except Exception as e:
+            print(f"Ошибка записи метрик в {path}: {e}")
+
+async def serve_http(registry, port, host='127.0.0.1'):
+    """HTTP-эндпоинт с метриками для сборщика (на любой путь отдаётся render_text).
+    Текст собирается в пуле потоков: значения gauge могут запрашиваться у
+    общего хранилища рейтинга по сети"""
+    async def handle(reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            text = await asyncio.get_running_loop().run_in_executor(None, registry.render_text)
+            body = text.encode('utf-8')
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    return await asyncio.start_server(handle, host, port)
+
+# Общий реестр процесса
+metrics = Metrics()
@@ -0,0 +1,183 @@
+import asyncio
+import time
+from collections import OrderedDict
+import discord
+from metrics import metrics
+
+class NameResolver:
+    """Имена пользователей для топа, антитопа и истории.
+
+    Сначала имя ищется в кэше участников шлюза (guild.get_member, bot.get_user),
+    затем в собственном TTL+LRU-кэше, и только потом запрашивается через REST
+    (bot.fetch_user). Счётчики в self.stats показывают, откуда берутся имена.
+
+    Фоновые запросы (предзагрузка соседних страниц, прогрев) идут не больше
+    background_concurrency одновременно и уступают запросам, которых ждут
+    пользователи: пока такие есть, новый фоновый запрос не начинается."""
+    def __init__(self, bot, ttl=3600, max_size=10000, concurrency=5, lookup_timeout=2.0,
+                 background_concurrency=1):
+        self.bot = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lookup_timeout = lookup_timeout
+        self._cache = OrderedDict()
+        # Одновременных REST-запросов не больше concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._background_semaphore = asyncio.Semaphore(background_concurrency)
+        # Запросы, которых ждут пользователи (ждут слота или уже идут)
+        self._foreground = 0
+        self._no_foreground = asyncio.Event()
+        self._no_foreground.set()
+        # До этого момента (time.monotonic) REST-запросы не делаются из-за лимита
+        self._blocked_until = 0.0
+        self.stats = {
+            'member_hits': 0,
+            'user_hits': 0,
+            'cache_hits': 0,
+            'misses': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'rate_limited': 0,
+            'invalidations': 0
+        }
+    
+    @staticmethod
+    def fallback(user_id):
+        return f"Пользователь {user_id}"
+    
+    def get_cached(self, user_id, guild=None):
+        """Имя без запросов к API или None, если его нет ни в одном кэше"""
+        user_id = int(user_id)
+        if guild is not None:
+            member = guild.get_member(user_id)
+            if member is not None:
+                self.stats['member_hits'] += 1
+                return member.display_name
+        user = self.bot.get_user(user_id)
+        if user is not None:
+            self.stats['user_hits'] += 1
+            return user.display_name
+        
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            name, expires_at = cached
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(user_id)
+                self.stats['cache_hits'] += 1
+                return name
+            del self._cache[user_id]
+        return None
+    
+    def snapshot(self, guild=None):
+        """Все имена, известные без запросов к API: {user_id (int): имя}.
+        Копия для рабочих потоков (выгрузка), которым нельзя читать кэши бота"""
+        now = time.monotonic()
+        known = {user_id: name for user_id, (name, expires_at) in self._cache.items() if expires_at > now}
+        if guild is not None:
+            known.update((member.id, member.display_name) for member in guild.members)
+        return known
+    
+    def _is_cached(self, user_id, guild=None):
+        # Как get_cached, но без счётчиков попаданий
+        user_id = int(user_id)
+        if guild is not None and guild.get_member(user_id) is not None:
+            return True
+        if self.bot.get_user(user_id) is not None:
+            return True
+        cached = self._cache.get(user_id)
+        return cached is not None and cached[1] > time.monotonic()
+    
+    def remember(self, user_id, name):
+        self._cache[int(user_id)] = (name, time.monotonic() + self.ttl)
+        self._cache.move_to_end(int(user_id))
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+    
+    def invalidate(self, user_id):
+        if self._cache.pop(int(user_id), None) is not None:
+            self.stats['invalidations'] += 1
+    
+    async def _fetch(self, user_id, background=False):
+        """Запросить имя через REST с ограничением параллельности и таймаутом"""
+        if background:
+            async with self._background_semaphore:
+                while self._foreground:
+                    await self._no_foreground.wait()
+                return await self._fetch_now(user_id)
+        self._foreground += 1
+        self._no_foreground.clear()
+        try:
+            return await self._fetch_now(user_id)
+        finally:
+            self._foreground -= 1
+            if not self._foreground:
+                self._no_foreground.set()
+    
+    async def _fetch_now(self, user_id):
+        async with self._semaphore:
+            # HTTP-клиент discord.py сам ждёт по заголовкам X-RateLimit; если же лимит
+            # исчерпан надолго, он бросает RateLimited - тогда до сброса не ходим в API
+            if time.monotonic() < self._blocked_until:
+                self.stats['rate_limited'] += 1
+                return self.fallback(user_id)
+            started = time.perf_counter()
+            try:
+                user = await asyncio.wait_for(self.bot.fetch_user(int(user_id)), timeout=self.lookup_timeout)
+            except asyncio.TimeoutError:
+                self.stats['timeouts'] += 1
+                return self.fallback(user_id)
+            except discord.RateLimited as e:
+                self.stats['rate_limited'] += 1
+                self._blocked_until = time.monotonic() + e.retry_after
+                return self.fallback(user_id)
+            except Exception:
+                self.stats['failures'] += 1
+                return self.fallback(user_id)
+            finally:
+                metrics.observe('rating_fetch_user_seconds', 'fetch_user', time.perf_counter() - started)
+        self.remember(user_id, user.display_name)
+        return user.display_name
+    
+    async def warm(self, user_ids, guild=None):
+        """Заранее запросить имена, которых нет в кэшах (прогрев после запуска).
+        Запросы фоновые, чтобы запросы команд не ждали свободного слота;
+        при исчерпанном лимите API прогрев прекращается. Возвращает число запросов"""
+        fetched = 0
+        for user_id in user_ids:
+            if time.monotonic() < self._blocked_until:
+                break
+            if not self._is_cached(user_id, guild):
+                await self._fetch(user_id, background=True)
+                fetched += 1
+        return fetched
+    
+    def resolve_cached(self, user_ids, guild=None):
+        """Имена только из кэшей, без запросов к API; неизвестные - «Пользователь {id}»"""
+        return [self.get_cached(user_id, guild) or self.fallback(user_id) for user_id in user_ids]
+    
+    async def resolve(self, user_id, guild=None):
+        """Отображаемое имя пользователя; при ошибке - «Пользователь {id}»"""
+        return (await self.resolve_many([user_id], guild))[0]
+    
+    async def resolve_many(self, user_ids, guild=None, background=False):
+        """Имена для списка пользователей в том же порядке.
+        
+        Имена из кэшей берутся сразу, остальные запрашиваются параллельно,
+        поэтому страница отрисовывается примерно за один запрос к API.
+        background - страница, которую пока никто не ждёт (предзагрузка)."""
+        resolved = {}
+        misses = []
+        for user_id in user_ids:
+            user_id = int(user_id)
+            if user_id in resolved:
+                continue
+            name = self.get_cached(user_id, guild)
+            resolved[user_id] = name
+            if name is None:
+                misses.append(user_id)
+        
+        if misses:
+            self.stats['misses'] += len(misses)
+            fetched = await asyncio.gather(*(self._fetch(user_id, background) for user_id in misses))
+            resolved.update(zip(misses, fetched))
+        return [resolved[int(user_id)] for user_id in user_ids]
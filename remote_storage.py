@@ -0,0 +1,288 @@
+import json
+import socket
+import threading
+from concurrent.futures import Future
+from database import RatingDatabase
+from storage import RatingStorage
+
+# Адрес store_server.py по умолчанию
+DEFAULT_ADDRESS = 'unix:/data/rating-store.sock'
+# Сколько строк выгрузки запрашивается за раз
+CURSOR_CHUNK = 1000
+
+class StoreError(Exception):
+    """Ошибка, которую вернул store_server.py на запрос"""
+
+def parse_address(address):
+    """'unix:/путь' -> (AF_UNIX, путь), 'хост:порт' -> (AF_INET, (хост, порт))"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+def encode(message):
+    return json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n'
+
+class StoreClient:
+    """Соединение с общим хранилищем рейтинга (store_server.py).
+
+    Запрос - строка JSON [номер, guild_id, метод, аргументы], ответ -
+    [номер, результат] или [номер, None, ошибка]. Запросы можно отправлять из
+    любых потоков, не дожидаясь ответов на предыдущие (submit() возвращает
+    Future): ответы разбирает отдельный поток чтения. Запросы, накопившиеся,
+    пока отправлялся предыдущий пакет, уходят в сокет одной записью.
+    После разрыва соединения следующий запрос подключается заново."""
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=10.0):
+        self.address = address
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._pending = {}
+        self._outgoing = []
+        self._sending = False
+        self._next_id = 0
+    
+    def _connect(self):
+        family, target = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(target)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+        return sock
+    
+    def _read_loop(self, sock):
+        error = ConnectionError(f"Соединение с хранилищем {self.address} закрыто")
+        try:
+            with sock.makefile('rb') as f:
+                for line in f:
+                    request_id, result, *failure = json.loads(line)
+                    with self._lock:
+                        future = self._pending.pop(request_id, None)
+                    if future is None:
+                        continue
+                    if failure:
+                        future.set_exception(StoreError(failure[0]))
+                    else:
+                        future.set_result(result)
+        except (OSError, ValueError) as e:
+            error = ConnectionError(f"Соединение с хранилищем {self.address} прервано: {e}")
+        self._disconnect(sock, error)
+    
+    def _disconnect(self, sock, error):
+        """Закрыть соединение; ждущие ответа запросы завершаются ошибкой"""
+        with self._lock:
+            if self._socket is not sock:
+                return
+            self._socket = None
+            pending, self._pending = self._pending, {}
+        sock.close()
+        for future in pending.values():
+            future.set_exception(error)
+    
+    def submit(self, guild_id, method, *args):
+        """Отправить запрос, не дожидаясь ответа"""
+        future = Future()
+        with self._lock:
+            if self._socket is None:
+                self._socket = self._connect()
+            self._next_id += 1
+            self._pending[self._next_id] = future
+            self._outgoing.append(encode([self._next_id, guild_id, method, args]))
+            if self._sending:
+                # Отправит поток, который сейчас пишет в сокет
+                return future
+            self._sending = True
+        self._send_outgoing()
+        return future
+    
+    def _send_outgoing(self):
+        while True:
+            with self._lock:
+                if not self._outgoing or self._socket is None:
+                    self._outgoing = []
+                    self._sending = False
+                    return
+                payload, self._outgoing = b''.join(self._outgoing), []
+                sock = self._socket
+            try:
+                sock.sendall(payload)
+            except OSError as e:
+                self._disconnect(sock, ConnectionError(f"Не удалось отправить запрос хранилищу {self.address}: {e}"))
+    
+    def call(self, guild_id, method, *args):
+        return self.submit(guild_id, method, *args).result(self.timeout)
+    
+    def close(self):
+        with self._lock:
+            sock = self._socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class RemoteLeaderboard:
+    """Топ сервера (или окна window) в общем хранилище.
+    Страницы не фиксируются на версии: snapshot() возвращает сам топ"""
+    def __init__(self, client, guild_id, window=None):
+        self.client = client
+        self.guild_id = guild_id
+        self.window = window
+    
+    def _call(self, operation, *args):
+        return self.client.call(self.guild_id, 'leaderboard', self.window, operation, *args)
+    
+    @property
+    def version(self):
+        return self._call('version')
+    
+    def snapshot(self):
+        return self
+    
+    def __len__(self):
+        return self._call('len')
+    
+    def __contains__(self, user_id):
+        return self.rank(user_id) is not None
+    
+    def page(self, offset, limit):
+        return [tuple(row) for row in self._call('page', offset, limit)]
+    
+    def read_page(self, offset, limit):
+        version, count, rows = self._call('read_page', offset, limit)
+        return version, count, [tuple(row) for row in rows]
+    
+    def top(self, limit=10):
+        return self.page(0, limit)
+    
+    def bottom(self, limit=10):
+        return [tuple(row) for row in self._call('bottom', limit)]
+    
+    def rank(self, user_id):
+        return self._call('rank', str(user_id))
+
+class RemoteStorage(RatingStorage):
+    """Хранилище сервера guild_id в общем store_server.py.
+
+    Транзакция отправляется одним запросом с изменениями amounts, а не с
+    итоговыми значениями, поэтому одновременные записи из разных процессов
+    не затирают друг друга. Запись на диск делает сам store_server.py."""
+    def __init__(self, client, guild_id):
+        self.client = client
+        self.guild_id = int(guild_id)
+        self.leaderboard = RemoteLeaderboard(client, self.guild_id)
+    
+    def _call(self, method, *args):
+        return self.client.call(self.guild_id, method, *args)
+    
+    def get_rating(self, user_id):
+        return self._call('get_rating', str(user_id))
+    
+    def get_ratings(self, user_ids):
+        return self._call('get_ratings', [str(user_id) for user_id in user_ids])
+    
+    def apply(self, ratings, history):
+        self._call('apply', {}, history, ratings)
+    
+    def apply_transaction(self, tx):
+        if not tx.amounts and not tx.history:
+            return
+        # В ответ - значения, которые получились в хранилище
+        tx.ratings.update(self._call('apply', tx.amounts, tx.history, {}))
+    
+    def get_rating_history(self, user_id, limit=5, offset=0):
+        return self._call('get_rating_history', str(user_id), limit, offset)
+    
+    def count_rating_history(self, user_id):
+        return self._call('count_rating_history', str(user_id))
+    
+    def get_changes_by(self, changer_id, limit=5, offset=0):
+        return self._call('get_changes_by', str(changer_id), limit, offset)
+    
+    def count_changes_by(self, changer_id):
+        return self._call('count_changes_by', str(changer_id))
+    
+    def get_recent_history(self, limit=5, offset=0):
+        return self._call('get_recent_history', limit, offset)
+    
+    def count_history(self):
+        return self._call('count_history')
+    
+    def get_window_leaderboard(self, window):
+        return RemoteLeaderboard(self.client, self.guild_id, window)
+    
+    def get_audit(self, window=None):
+        return self._call('get_audit', window)
+    
+    def run_decay(self, every_days, percent, inactive_days, changer_id):
+        """decay.run_decay одним запросом: срок проверяется и затухание применяется
+        в хранилище без записей других процессов между ними"""
+        return self._call('run_decay', every_days, percent, inactive_days, str(changer_id))
+    
+    def iter_ratings(self):
+        return map(tuple, self._iter_cursor(self._call('iter_ratings')))
+    
+    def iter_history(self, since=None, until=None, user_id=None):
+        user_id = str(user_id) if user_id is not None else None
+        return self._iter_cursor(self._call('iter_history', since, until, user_id))
+    
+    def _iter_cursor(self, cursor):
+        """Строки открытой на сервере выгрузки; следующая порция запрашивается
+        до того, как обработана текущая"""
+        finished = False
+        try:
+            future = self.client.submit(self.guild_id, 'next', cursor, CURSOR_CHUNK)
+            while not finished:
+                rows = future.result(self.client.timeout)
+                # Неполная порция - последняя, сервер уже закрыл выгрузку
+                finished = len(rows) < CURSOR_CHUNK
+                if not finished:
+                    future = self.client.submit(self.guild_id, 'next', cursor, CURSOR_CHUNK)
+                yield from rows
+        finally:
+            if not finished:
+                self.client.submit(self.guild_id, 'close_cursor', cursor)
+
+class RemoteShards:
+    """Замена GuildShards, когда базы серверов живут в store_server.py:
+    на каждый сервер - RatingDatabase с RemoteStorage поверх одного соединения"""
+    def __init__(self, client):
+        self.client = client
+        self.on_dirty = None
+        self._shards = {}
+    
+    def get(self, guild_id):
+        guild_id = int(guild_id)
+        db = self._shards.get(guild_id)
+        if db is None:
+            db = self._shards[guild_id] = RatingDatabase(storage=RemoteStorage(self.client, guild_id))
+        return db
+    
+    def get_loaded(self, guild_id):
+        # Базы общего хранилища открываются без обращения к нему
+        return self.get(guild_id)
+    
+    def __iter__(self):
+        return iter(list(self._shards.values()))
+    
+    def loaded_guilds(self):
+        return list(self._shards)
+    
+    def stored_guilds(self):
+        return self.client.call(None, 'stored_guilds')
+    
+    @property
+    def legacy_guild_id(self):
+        return self.client.call(None, 'legacy_guild_id')
+    
+    @legacy_guild_id.setter
+    def legacy_guild_id(self, guild_id):
+        # Общее хранилище старых версий достаётся серверу, который назовёт первый процесс
+        self.client.call(None, 'set_legacy_guild_id', guild_id)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.client.close()
@@ -0,0 +1,272 @@
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from database import RatingDatabase
+from sqlite_storage import SqliteStorage
+
+# Файлы общего хранилища, которые жили прямо в корне до разделения по серверам
+LEGACY_FILES = (
+    'ratings.json', 'ratings.journal', 'history.json', 'history.json.migrated', 'history',
+    'ratings.sqlite3', 'ratings.sqlite3-wal', 'ratings.sqlite3-shm'
+)
+
+class GuildShards:
+    """Рейтинг и история отдельно для каждого сервера.
+
+    База сервера (RatingDatabase из open_shard(data_dir)) лежит в
+    root/guilds/<guild_id> и открывается при первой команде с этого сервера.
+    Если открыто больше max_shards баз или в них больше max_users
+    пользователей, давно не использованные базы сохраняются и закрываются.
+    База, к которой обращались меньше min_idle секунд назад, не закрывается:
+    ею могут пользоваться открытые !топ и !история.
+
+    Снаружи объект ведёт себя как одна база для BackgroundFlusher:
+    on_dirty и flush() распространяются на все открытые базы. Базы можно
+    открывать из рабочего потока (прогрев после запуска бота). Открытие и
+    закрытие идут без общей блокировки, поэтому, пока загружается одна база,
+    остальные доступны; одна и та же база не откроется дважды и не откроется
+    снова, пока её прежняя копия сохраняется при закрытии."""
+    def __init__(self, root, open_shard, max_shards=100, max_users=None, min_idle=600,
+                 legacy_guild_id=None):
+        self.root = root
+        self.open_shard = open_shard
+        self.max_shards = max_shards
+        self.max_users = max_users
+        self.min_idle = min_idle
+        # Сервер, которому достаётся общее хранилище из старых версий бота
+        self._legacy_guild_id = legacy_guild_id
+        self._on_dirty = None
+        self._shards = OrderedDict()
+        self._last_used = {}
+        self._lock = threading.Lock()
+        # Базы, которые сейчас открываются и закрываются: {guild_id: Future}
+        self._opening = {}
+        self._closing = {}
+    
+    def _shard_dir(self, guild_id):
+        return os.path.join(self.root, 'guilds', str(guild_id))
+    
+    @property
+    def legacy_guild_id(self):
+        return self._legacy_guild_id
+    
+    @legacy_guild_id.setter
+    def legacy_guild_id(self, guild_id):
+        """Назначить сервер для общего хранилища старых версий. Если его база
+        уже открыта пустой (команда пришла раньше, чем стал известен сервер),
+        она закрывается, и при следующем обращении хранилище переносится в неё"""
+        self._legacy_guild_id = guild_id
+        if guild_id is None or not self._has_legacy_files():
+            return
+        guild_id = int(guild_id)
+        with self._lock:
+            db = self._shards.get(guild_id)
+            if db is None or not self._is_empty(db):
+                return
+            detached = [(guild_id, self._detach(guild_id))]
+        threading.Thread(target=self._close_detached, args=(detached,)).start()
+    
+    def _has_legacy_files(self):
+        return any(os.path.exists(os.path.join(self.root, name)) for name in LEGACY_FILES)
+    
+    def _is_empty(self, db):
+        return not db.count_users() and not db.storage.count_history()
+    
+    def _adopt_legacy_files(self, data_dir):
+        """Перенести общее хранилище старых версий в каталог сервера
+        (файлы пустой базы, открытой там раньше, заменяются)"""
+        for name in LEGACY_FILES:
+            path = os.path.join(data_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        moved = []
+        for name in LEGACY_FILES:
+            path = os.path.join(self.root, name)
+            if os.path.exists(path):
+                shutil.move(path, os.path.join(data_dir, name))
+                moved.append(name)
+        if moved:
+            print(f"Общее хранилище рейтинга перенесено в {data_dir}: {', '.join(moved)}")
+    
+    def _use(self, guild_id):
+        # Вызывается под self._lock
+        self._shards.move_to_end(guild_id)
+        self._last_used[guild_id] = time.monotonic()
+    
+    def get(self, guild_id):
+        """База сервера; открывается при первом обращении"""
+        guild_id = int(guild_id)
+        with self._lock:
+            db = self._shards.get(guild_id)
+            if db is not None:
+                self._use(guild_id)
+        if db is None:
+            db = self._get_opening(guild_id)
+        self.evict()
+        return db
+    
+    def get_loaded(self, guild_id):
+        """База сервера, если она уже открыта (иначе None); не ждёт ни открытия,
+        ни закрытия, поэтому годится для цикла событий"""
+        guild_id = int(guild_id)
+        with self._lock:
+            db = self._shards.get(guild_id)
+            if db is not None:
+                self._use(guild_id)
+        return db
+    
+    def _get_opening(self, guild_id):
+        """Открыть базу или дождаться потока, который её уже открывает"""
+        with self._lock:
+            db = self._shards.get(guild_id)
+            if db is not None:
+                self._use(guild_id)
+                return db
+            opening = self._opening.get(guild_id)
+            if opening is not None:
+                owner = False
+            else:
+                owner = True
+                opening = self._opening[guild_id] = Future()
+                closing = self._closing.get(guild_id)
+        if not owner:
+            return opening.result()
+        
+        try:
+            if closing is not None:
+                # Прежняя копия базы ещё сохраняется
+                closing.result()
+            db = self._open(guild_id)
+        except BaseException as e:
+            with self._lock:
+                del self._opening[guild_id]
+            opening.set_exception(e)
+            raise
+        with self._lock:
+            del self._opening[guild_id]
+            self._shards[guild_id] = db
+            self._use(guild_id)
+        opening.set_result(db)
+        return db
+    
+    def _open(self, guild_id):
+        data_dir = self._shard_dir(guild_id)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        db = self.open_shard(data_dir)
+        if (self.legacy_guild_id is not None and int(self.legacy_guild_id) == guild_id
+                and self._has_legacy_files() and self._is_empty(db)):
+            # Общее хранилище переносится, пока в базе сервера нет данных,
+            # даже если каталог создала команда, пришедшая раньше назначения сервера
+            db.close()
+            self._adopt_legacy_files(data_dir)
+            db = self.open_shard(data_dir)
+        db.on_dirty = self._on_dirty
+        return db
+    
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._shards.values()))
+    
+    def loaded_guilds(self):
+        with self._lock:
+            return list(self._shards)
+    
+    def stored_guilds(self):
+        """Серверы, у которых на диске уже есть база (открытые и закрытые)"""
+        guilds_dir = os.path.join(self.root, 'guilds')
+        stored = set(self.loaded_guilds())
+        if os.path.isdir(guilds_dir):
+            stored.update(int(name) for name in os.listdir(guilds_dir) if name.isdigit())
+        if self.legacy_guild_id is not None and any(
+                os.path.exists(os.path.join(self.root, name)) for name in LEGACY_FILES):
+            stored.add(int(self.legacy_guild_id))
+        return sorted(stored)
+    
+    def _over_limit(self):
+        if len(self._shards) > self.max_shards:
+            return True
+        if self.max_users is not None:
+            return sum(db.count_users() for db in self._shards.values()) > self.max_users
+        return False
+    
+    def evict(self):
+        """Закрыть самые давно использованные базы, пока не уложимся в лимиты.
+        Базы сохраняются и закрываются в отдельном потоке"""
+        evicted = []
+        with self._lock:
+            now = time.monotonic()
+            for guild_id in list(self._shards):
+                if not self._over_limit():
+                    break
+                if now - self._last_used[guild_id] < self.min_idle:
+                    # Дальше по LRU базы использовались ещё позже
+                    break
+                evicted.append((guild_id, self._detach(guild_id)))
+        if evicted:
+            threading.Thread(target=self._close_detached, args=(evicted,)).start()
+    
+    def _detach(self, guild_id):
+        # Вызывается под self._lock: база больше не выдаётся, но ещё не закрыта
+        db = self._shards.pop(guild_id)
+        del self._last_used[guild_id]
+        db.on_dirty = None
+        self._closing[guild_id] = Future()
+        return db
+    
+    def _close_detached(self, detached):
+        for guild_id, db in detached:
+            closing = self._closing[guild_id]
+            try:
+                db.close()
+            except Exception as e:
+                print(f"Ошибка сохранения базы сервера {guild_id}: {e}")
+            with self._lock:
+                del self._closing[guild_id]
+            closing.set_result(None)
+    
+    @property
+    def on_dirty(self):
+        return self._on_dirty
+    
+    @on_dirty.setter
+    def on_dirty(self, callback):
+        self._on_dirty = callback
+        for db in self:
+            db.on_dirty = callback
+    
+    def flush(self):
+        for db in self:
+            db.flush()
+    
+    def close(self):
+        """Сохранить и закрыть все базы, дождавшись и тех, что закрываются в фоне"""
+        with self._lock:
+            detached = [(guild_id, self._detach(guild_id)) for guild_id in list(self._shards)]
+            closing = list(self._closing.values())
+        self._close_detached(detached)
+        for future in closing:
+            future.result()
+
+def open_guild_db(data_dir):
+    # RATING_STORAGE=sqlite - хранилище SQLite; при первом запуске в него переносятся JSON-файлы сервера
+    if os.getenv('RATING_STORAGE', 'json') == 'sqlite':
+        return RatingDatabase(storage=SqliteStorage(os.path.join(data_dir, 'ratings.sqlite3'), migrate_from=data_dir))
+    return RatingDatabase(data_dir=data_dir, journal=True)
+
+def shards_from_env(root='/data'):
+    """Базы серверов с настройками из переменных окружения (бот и store_server.py).
+    Простаивающие базы закрываются сверх RATING_MAX_SHARDS баз или RATING_MAX_USERS
+    пользователей в памяти"""
+    return GuildShards(
+        root,
+        open_guild_db,
+        max_shards=int(os.getenv('RATING_MAX_SHARDS', '100')),
+        max_users=int(os.getenv('RATING_MAX_USERS')) if os.getenv('RATING_MAX_USERS') else None,
+        legacy_guild_id=os.getenv('RATING_LEGACY_GUILD_ID')
+    )
@@ -0,0 +1,224 @@
+import os
+import sqlite3
+from audit import AuditAggregates
+from leaderboard import VersionedLeaderboard
+from storage import JsonStorage, RatingStorage
+from windows import SERVER_USER_ID, TimeWindows
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ratings (
+    user_id TEXT PRIMARY KEY,
+    rating INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ratings_by_rating ON ratings (rating DESC, user_id);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    changer_id TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    comment TEXT
+);
+CREATE INDEX IF NOT EXISTS history_by_target ON history (target_id, timestamp);
+CREATE INDEX IF NOT EXISTS history_by_changer ON history (changer_id, timestamp);
+CREATE INDEX IF NOT EXISTS history_by_time ON history (timestamp);
+"""
+
+# Запросы - константы с параметрами: sqlite3 держит их скомпилированными в кэше соединения
+HISTORY_COLUMNS = "timestamp, changer_id, target_id, amount, comment"
+SQL_GET_RATING = "SELECT rating FROM ratings WHERE user_id = ?"
+SQL_UPSERT_RATING = ("INSERT INTO ratings (user_id, rating) VALUES (?, ?) "
+                     "ON CONFLICT (user_id) DO UPDATE SET rating = excluded.rating")
+SQL_INSERT_HISTORY = f"INSERT INTO history ({HISTORY_COLUMNS}) VALUES (?, ?, ?, ?, ?)"
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM ratings"
+SQL_PAGE = "SELECT user_id, rating FROM ratings ORDER BY rating DESC, user_id LIMIT ? OFFSET ?"
+SQL_BOTTOM = "SELECT user_id, rating FROM ratings ORDER BY rating, user_id DESC LIMIT ?"
+SQL_RANK = "SELECT COUNT(*) FROM ratings WHERE rating > ? OR (rating = ? AND user_id < ?)"
+SQL_HISTORY_BY_TARGET = (f"SELECT {HISTORY_COLUMNS} FROM history WHERE target_id = ? "
+                         "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?")
+SQL_COUNT_BY_TARGET = "SELECT COUNT(*) FROM history WHERE target_id = ?"
+SQL_HISTORY_BY_CHANGER = (f"SELECT {HISTORY_COLUMNS} FROM history WHERE changer_id = ? "
+                          "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?")
+SQL_COUNT_BY_CHANGER = "SELECT COUNT(*) FROM history WHERE changer_id = ?"
+SQL_RECENT_HISTORY = f"SELECT {HISTORY_COLUMNS} FROM history ORDER BY id DESC LIMIT ? OFFSET ?"
+SQL_COUNT_HISTORY = "SELECT COUNT(*) FROM history"
+SQL_HISTORY_SINCE = f"SELECT {HISTORY_COLUMNS} FROM history WHERE timestamp >= ? ORDER BY id"
+SQL_EXPORT_RATINGS = "SELECT user_id, rating FROM ratings ORDER BY rating DESC, user_id"
+SQL_EXPORT_HISTORY = (f"SELECT {HISTORY_COLUMNS} FROM history WHERE timestamp >= ? AND timestamp < ? "
+                      "AND (? IS NULL OR target_id = ? OR changer_id = ?) ORDER BY id")
+SQL_AUDIT_TOTALS = ("SELECT changer_id, target_id, SUM(MAX(amount, 0)), SUM(MAX(-amount, 0)), COUNT(*) "
+                    "FROM history WHERE target_id <> ? GROUP BY changer_id, target_id")
+# Строк за одно чтение курсора при выгрузке
+EXPORT_FETCH_ROWS = 1000
+
+def _history_entry(row):
+    timestamp, changer_id, target_id, amount, comment = row
+    return {
+        'timestamp': timestamp,
+        'changer_id': changer_id,
+        'target_id': target_id,
+        'amount': amount,
+        'comment': comment
+    }
+
+def _history_row(entry):
+    return (entry['timestamp'], str(entry['changer_id']), str(entry['target_id']),
+            entry['amount'], entry.get('comment'))
+
+class SqliteLeaderboard(VersionedLeaderboard):
+    """Топ, который читается запросами к таблице ratings по индексу рейтинга"""
+    def __init__(self, connection):
+        super().__init__()
+        self._connection = connection
+    
+    def __len__(self):
+        return self._connection.execute(SQL_COUNT_USERS).fetchone()[0]
+    
+    def __contains__(self, user_id):
+        return self._connection.execute(SQL_GET_RATING, (str(user_id),)).fetchone() is not None
+    
+    def page(self, offset, limit):
+        if limit <= 0:
+            return []
+        return [tuple(row) for row in self._connection.execute(SQL_PAGE, (limit, max(offset, 0)))]
+    
+    def bottom(self, limit=10):
+        return [tuple(row) for row in self._connection.execute(SQL_BOTTOM, (limit,))]
+    
+    def rank(self, user_id):
+        user_id = str(user_id)
+        row = self._connection.execute(SQL_GET_RATING, (user_id,)).fetchone()
+        if row is None:
+            return None
+        rating = row[0]
+        return self._connection.execute(SQL_RANK, (rating, rating, user_id)).fetchone()[0] + 1
+
+class SqliteStorage(RatingStorage):
+    """Хранилище в SQLite (режим WAL).
+
+    Рейтинги не держатся в памяти: топ, место пользователя и история
+    выбираются запросами по индексам. Если база пуста, а migrate_from указывает
+    на каталог с JSON-хранилищем, данные из него переносятся один раз.
+    Топы за день/неделю/месяц строятся при открытии из истории последних дней
+    и дальше обновляются в памяти. Так же устроена сводка действий
+    модераторов: итоги за всё время считаются одним GROUP BY при открытии."""
+    def __init__(self, path='/data/ratings.sqlite3', migrate_from=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # FULL: подтверждённая транзакция уже на диске, как и в журнале JsonStorage
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.executescript(SCHEMA)
+        self.leaderboard = SqliteLeaderboard(self._connection)
+        if migrate_from is not None and self._is_empty():
+            self.migrate_from_json(migrate_from)
+        self.load_windows()
+    
+    def load_windows(self):
+        self.windows = TimeWindows()
+        self.audit = AuditAggregates()
+        for changer_id, target_id, *counters in self._connection.execute(SQL_AUDIT_TOTALS, (str(SERVER_USER_ID),)):
+            self.audit.totals.setdefault(changer_id, {})[target_id] = counters
+        for row in self._connection.execute(SQL_HISTORY_SINCE, (self.windows.first_day(),)):
+            entry = _history_entry(row)
+            self.windows.add(entry)
+            self.audit.add_day(entry)
+    
+    def _is_empty(self):
+        return (self._connection.execute("SELECT 1 FROM ratings LIMIT 1").fetchone() is None
+                and self._connection.execute("SELECT 1 FROM history LIMIT 1").fetchone() is None)
+    
+    def migrate_from_json(self, data_dir):
+        """Перенести ratings.json и историю из JSON-хранилища в каталоге data_dir"""
+        if not os.path.exists(os.path.join(data_dir, 'ratings.json')):
+            return
+        # JsonStorage сам применит журнал и перенесёт старый history.json в сегменты
+        source = JsonStorage(data_dir=data_dir, journal=True)
+        try:
+            with self._connection:
+                self._connection.execute("BEGIN IMMEDIATE")
+                self._connection.executemany(SQL_UPSERT_RATING, ((str(user_id), rating)
+                                                                 for user_id, rating in source.data.items()))
+                self._connection.executemany(SQL_INSERT_HISTORY,
+                                             map(_history_row, source.history_store.iter_all()))
+        finally:
+            source.close()
+        self.leaderboard._before_change()
+        print(f"Данные рейтинга перенесены из {data_dir} в {self.path}")
+    
+    def get_rating(self, user_id):
+        row = self._connection.execute(SQL_GET_RATING, (str(user_id),)).fetchone()
+        return row[0] if row is not None else 0
+    
+    def apply(self, ratings, history):
+        """Применить изменения транзакции одной SQL-транзакцией"""
+        if not ratings and not history:
+            return
+        if ratings:
+            self.leaderboard._before_change()
+        with self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany(SQL_UPSERT_RATING, ratings.items())
+            self._connection.executemany(SQL_INSERT_HISTORY, map(_history_row, history))
+        for entry in history:
+            self.windows.add(entry)
+            self.audit.add(entry)
+    
+    def _history(self, sql, params):
+        return [_history_entry(row) for row in self._connection.execute(sql, params)]
+    
+    def get_rating_history(self, user_id, limit=5, offset=0):
+        return self._history(SQL_HISTORY_BY_TARGET, (str(user_id), limit, offset))
+    
+    def count_rating_history(self, user_id):
+        return self._connection.execute(SQL_COUNT_BY_TARGET, (str(user_id),)).fetchone()[0]
+    
+    def get_changes_by(self, changer_id, limit=5, offset=0):
+        return self._history(SQL_HISTORY_BY_CHANGER, (str(changer_id), limit, offset))
+    
+    def count_changes_by(self, changer_id):
+        return self._connection.execute(SQL_COUNT_BY_CHANGER, (str(changer_id),)).fetchone()[0]
+    
+    def get_recent_history(self, limit=5, offset=0):
+        return self._history(SQL_RECENT_HISTORY, (limit, offset))
+    
+    def count_history(self):
+        return self._connection.execute(SQL_COUNT_HISTORY).fetchone()[0]
+    
+    def _export_rows(self, sql, params):
+        """Строки запроса из отдельного соединения в рабочем потоке. Чтение идёт
+        в одной транзакции: WAL отдаёт снимок базы на её начало и не мешает записи"""
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            connection.execute("BEGIN")
+            cursor = connection.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+                if not rows:
+                    break
+                yield from rows
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+    
+    def iter_ratings(self):
+        for rank, (user_id, rating) in enumerate(self._export_rows(SQL_EXPORT_RATINGS, ()), 1):
+            yield rank, user_id, rating
+    
+    def iter_history(self, since=None, until=None, user_id=None):
+        user_id = str(user_id) if user_id is not None else None
+        # Время хранится ISO-строкой, поэтому границы сравниваются как строки
+        params = (since or '', until or '\uffff', user_id, user_id, user_id)
+        return map(_history_entry, self._export_rows(SQL_EXPORT_HISTORY, params))
+    
+    def get_window_leaderboard(self, window):
+        return self.windows.leaderboard(window)
+    
+    def get_audit(self, window=None):
+        return self.audit.period(window)
+    
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,475 @@
+import json
+import os
+import threading
+import time
+from history import HistoryStore
+from leaderboard import Leaderboard
+from metrics import BYTES_BUCKETS, metrics
+
+class RatingStorage:
+    """Интерфейс хранилища рейтинга для RatingDatabase.
+
+    leaderboard - упорядоченный топ (version, len(), page(), top(), bottom(),
+    rank(), snapshot()). apply() сохраняет изменения одной транзакции атомарно.
+    Записи истории - словари (или HistoryRecord, которые читаются так же)
+    с ключами timestamp, changer_id, target_id, amount, comment; запросы
+    истории возвращают их новыми первыми."""
+    # Вызывается после изменения, если запись на диск выполняется в фоне
+    on_dirty = None
+    
+    def get_rating(self, user_id):
+        raise NotImplementedError
+    
+    def get_ratings(self, user_ids):
+        """{user_id (str): рейтинг} для нескольких пользователей сразу"""
+        return {str(user_id): self.get_rating(user_id) for user_id in user_ids}
+    
+    def apply(self, ratings, history):
+        """Записать новые значения рейтингов {user_id: рейтинг} и записи истории"""
+        raise NotImplementedError
+    
+    def apply_transaction(self, tx):
+        """Сохранить RatingTransaction; локальное хранилище записывает итоговые значения"""
+        self.apply(tx.ratings, tx.history)
+    
+    def get_rating_history(self, user_id, limit=5, offset=0):
+        raise NotImplementedError
+    
+    def count_rating_history(self, user_id):
+        raise NotImplementedError
+    
+    def get_changes_by(self, changer_id, limit=5, offset=0):
+        raise NotImplementedError
+    
+    def count_changes_by(self, changer_id):
+        raise NotImplementedError
+    
+    def get_recent_history(self, limit=5, offset=0):
+        raise NotImplementedError
+    
+    def count_history(self):
+        raise NotImplementedError
+    
+    def get_window_leaderboard(self, window):
+        """Топ по сумме изменений за окно window (day, week, month из windows.py)"""
+        raise NotImplementedError
+    
+    def get_audit(self, window=None):
+        """Сводка действий модераторов {changer_id: {target_id: [выдано, снято, изменений]}}
+        за окно window (day, week, month) или за всё время (см. audit.py)"""
+        raise NotImplementedError
+    
+    def iter_ratings(self):
+        """(место, user_id, рейтинг) от первого места для выгрузки.
+        Порядок фиксируется при вызове; обходить можно из рабочего потока"""
+        raise NotImplementedError
+    
+    def iter_history(self, since=None, until=None, user_id=None):
+        """Записи истории от старых к новым со временем since <= t < until
+        (ISO-строки); с user_id - только изменения пользователя и сделанные им.
+        Обходить можно из рабочего потока, в память всё сразу не читается"""
+        raise NotImplementedError
+    
+    def flush(self):
+        """Записать на диск всё, что ещё не записано"""
+    
+    def close(self):
+        self.flush()
+
+class JsonStorage(RatingStorage):
+    """Хранилище в JSON-файлах: ratings.json, журнал и сегменты истории.
+
+    Все рейтинги держатся в памяти в упорядоченном индексе для топа; data -
+    его же словарь {user_id (int): рейтинг}, в файлах ключи остаются строками."""
+    def __init__(self, filename='ratings.json', history_filename='history.json',
+                 journal_filename='ratings.journal', history_dirname='history',
+                 data_dir='/data', journal=False, compact_every=1000, history_index_limit=100):
+        self.filename = filename
+        self.history_filename = history_filename
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.filename = os.path.join(data_dir, filename)
+        self.history_filename = os.path.join(data_dir, history_filename)
+        self.journal_filename = os.path.join(data_dir, journal_filename)
+        self.history_dirname = os.path.join(data_dir, history_dirname)
+        # Журнальный режим: каждое изменение дописывается одной строкой в журнал,
+        # а полный снимок ratings.json пишется раз в compact_every записей
+        self.journal = journal
+        self.compact_every = compact_every
+        self._journal_file = None
+        self._journal_records = 0
+        # Несохранённые записи. Если задан on_dirty, запись на диск делает фоновый
+        # flush() (см. flusher.py), иначе она происходит сразу при каждом изменении.
+        # В журнальном режиме изменение подтверждается записью в журнал ещё в apply(),
+        # а в фоне пишутся только сегменты истории и снимок
+        self.on_dirty = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        # Сколько последних записей истории на пользователя индексируется в памяти
+        self.history_index_limit = history_index_limit
+        self.load_data()
+        self.load_history()
+        if self.journal:
+            self.replay_journal()
+        # Упорядоченный индекс для топа, антитопа и места пользователя; отдельной
+        # копии рейтингов не держим - data дальше меняется только через индекс
+        self.leaderboard = Leaderboard(self.data)
+        self.data = self.leaderboard.ratings
+    
+    def load_data(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                # json сам запишет числовые ключи строками, так что формат файла прежний
+                self.data = {int(user_id): rating for user_id, rating in json.load(f).items()}
+        else:
+            self.data = {}
+            self.save_data()
+    
+    def save_data(self):
+        self._write_json_atomic(self.filename, self.data)
+    
+    def load_history(self):
+        """Загрузить историю изменений рейтинга (в память - только активный сегмент)"""
+        self.history_store = HistoryStore(self.history_dirname, index_limit=self.history_index_limit)
+        # Старый history.json переносится в сегменты один раз
+        if os.path.exists(self.history_filename) and not self.history_store.segments:
+            self.history_store.migrate_from(self.history_filename)
+    
+    def save_history(self):
+        """Сохранить историю изменений рейтинга"""
+        with self._lock:
+            unwritten = self.history_store.take_unwritten()
+            manifest = self.history_store.take_manifest(include_active=True)
+        self.history_store.write(unwritten, sync=True)
+        self.history_store.write_manifest(manifest)
+    
+    def _write_json_atomic(self, path, obj):
+        """Записать JSON во временный файл и атомарно заменить им целевой; возвращает размер"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, path)
+        return size
+    
+    def _rotated_journals(self):
+        """Номера отложенных журналов ratings.journal.N (по возрастанию)"""
+        directory, name = os.path.split(self.journal_filename)
+        prefix = name + '.'
+        return sorted(int(filename[len(prefix):]) for filename in os.listdir(directory)
+                      if filename.startswith(prefix) and filename[len(prefix):].isdigit())
+    
+    def replay_journal(self):
+        """Применить к загруженному снимку записи из журналов: сначала отложенные
+        (их снимок не успел записаться), затем текущий"""
+        paths = [f"{self.journal_filename}.{number}" for number in self._rotated_journals()]
+        if os.path.exists(self.journal_filename):
+            paths.append(self.journal_filename)
+        
+        # Записи истории, которые уже есть в сегментах, пропускаем по номеру: seq -
+        # номер первой записи истории из записи журнала. В журналах старых версий
+        # номера нет, там - по времени
+        written = self.history_store.count()
+        last_timestamp = self.history_store.last_timestamp()
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная запись в конце журнала (сбой во время записи) - не была подтверждена
+                        print(f"Журнал {path}: пропущена поврежденная запись")
+                        break
+                    # В журнале хранятся итоговые значения, поэтому повторное применение безопасно
+                    self.data.update((int(user_id), rating) for user_id, rating in record.get('ratings', {}).items())
+                    seq = record.get('seq')
+                    for i, entry in enumerate(record.get('history', [])):
+                        if seq + i >= written if seq is not None else entry['timestamp'] > last_timestamp:
+                            self._append_history(entry)
+        
+        # Сразу переносим журналы в снимок, чтобы новые записи не шли после оборванной
+        if len(paths) > 1 or paths and os.path.getsize(paths[0]):
+            self.compact()
+    
+    def compact(self):
+        """Записать снимок данных и очистить журнал"""
+        self.flush(compact=True)
+    
+    def flush(self, compact=False):
+        """Записать накопленные изменения на диск.
+        
+        Безопасно вызывать из рабочего потока: данные копируются под блокировкой,
+        а запись в файлы идёт уже без неё. В журнальном режиме изменения уже
+        подтверждены журналом (см. apply()), здесь дописываются сегменты истории
+        и, время от времени, снимок. Без журнала изменения подтверждает снимок;
+        если его записать не удалось, дописанная история обрезается, а изменения
+        остаются в очереди.
+        
+        Перед снимком журнал откладывается (ratings.journal.N), и новые записи
+        идут в свежий файл: apply() ждёт только копирования данных, а не записи
+        снимка. Отложенные журналы удаляются, когда записаны снимок и вся
+        история из них."""
+        with self._flush_lock:
+            if not self.journal or not (compact or self._journal_records >= self.compact_every):
+                self._flush(self._take(compact))
+                return
+            with self._journal_lock:
+                taken = self._take(compact=True)
+                rotated = self._rotate_journal()
+            self._flush(taken, rotated)
+    
+    def _take(self, compact):
+        """Забрать то, что нужно записать (None - нечего)"""
+        with self._lock:
+            records, self._pending = self._pending, []
+            if not self.journal:
+                compact = compact or any(record['ratings'] for record in records)
+            history = self.history_store.take_unwritten()
+            if not records and not history and not compact:
+                return None
+            # Счётчики активного сегмента сохраняются вместе со снимком, чтобы
+            # при запуске не перечитывать сегмент целиком
+            manifest = self.history_store.take_manifest(include_active=compact)
+            data = dict(self.data) if compact else None
+        return records, history, manifest, data
+    
+    def _rotate_journal(self):
+        """Отложить текущий журнал (под self._journal_lock): следующие записи
+        пойдут в новый файл. Возвращает номер отложенного и число записей в нём"""
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        number = max(self._rotated_journals(), default=0) + 1
+        if os.path.exists(self.journal_filename):
+            os.replace(self.journal_filename, f"{self.journal_filename}.{number}")
+        rotated_records, self._journal_records = self._journal_records, 0
+        return number, rotated_records
+    
+    def _flush(self, taken, rotated=None):
+        if taken is None:
+            return
+        records, history, manifest, data = taken
+        compact = data is not None
+        
+        started = time.perf_counter()
+        written = 0
+        sizes = self.history_store.segment_sizes(history)
+        try:
+            # С журналом fsync сегментов нужен только перед удалением отложенного журнала
+            written += self.history_store.write(history, sync=compact or not self.journal)
+        except Exception:
+            self._restore_pending(records, history)
+            self._keep_rotated(rotated)
+            raise
+        if compact:
+            try:
+                written += self._write_snapshot(data, rotated)
+            except Exception:
+                if self.journal:
+                    # История уже и в журнале, и в сегментах; счётчики запишутся позже,
+                    # а отложенный журнал останется до следующего снимка
+                    self._restore_pending([], [])
+                    self._keep_rotated(rotated)
+                else:
+                    # Без журнала изменения подтверждает только снимок: история
+                    # не должна пережить их откат
+                    self.history_store.truncate(sizes)
+                    self._restore_pending(records, history)
+                raise
+        try:
+            self.history_store.write_manifest(manifest)
+        except Exception as e:
+            # Изменения уже сохранены; без свежих счётчиков при запуске перечитается хвост сегмента
+            self._restore_pending([], [])
+            print(f"Не удалось записать {self.history_store.manifest_filename}: {e}")
+        kind = 'snapshot' if compact else 'append'
+        metrics.observe('rating_flush_seconds', kind, time.perf_counter() - started)
+        metrics.observe('rating_flush_bytes', kind, written, BYTES_BUCKETS)
+    
+    def close(self):
+        """Сохранить все изменения, сбросить журнал в снимок и закрыть файлы"""
+        self.flush(compact=self.journal and (self._journal_records > 0 or bool(self._rotated_journals())))
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+    
+    def _keep_rotated(self, rotated):
+        # Снимок не записан: отложенный журнал остаётся, и его записи снова
+        # учитываются в compact_every, чтобы следующий flush() повторил снимок
+        if rotated is not None:
+            with self._journal_lock:
+                self._journal_records += rotated[1]
+    
+    def _restore_pending(self, records, history):
+        with self._lock:
+            self._pending[:0] = records
+            self.history_store.restore_unwritten(history)
+    
+    def _write_snapshot(self, data, rotated=None):
+        """Атомарно записать снимок рейтингов и удалить отложенные журналы,
+        которые он покрывает (rotated - из _rotate_journal()); возвращает размер снимка"""
+        size = self._write_json_atomic(self.filename, data)
+        if rotated is not None:
+            for number in self._rotated_journals():
+                if number <= rotated[0]:
+                    os.remove(f"{self.journal_filename}.{number}")
+        return size
+    
+    def _write_journal(self, records):
+        """Дописать записи в журнал и дождаться их записи на диск; возвращает число байт.
+        При ошибке журнал обрезается до прежнего размера: неподтверждённая запись
+        не должна примениться при перезапуске"""
+        if self._journal_file is None:
+            self._journal_file = open(self.journal_filename, 'a', encoding='utf-8')
+        size = os.path.getsize(self.journal_filename)
+        payload = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        try:
+            self._journal_file.write(payload)
+            self._journal_file.flush()
+            os.fsync(self._journal_file.fileno())
+        except Exception:
+            journal_file, self._journal_file = self._journal_file, None
+            try:
+                journal_file.close()
+            except Exception:
+                pass
+            os.truncate(self.journal_filename, size)
+            raise
+        self._journal_records += len(records)
+        return len(payload.encode('utf-8'))
+    
+    def _commit(self, ratings, history):
+        """Поставить изменения в очередь на запись (вызывается под self._lock)"""
+        record = {'ratings': ratings, 'history': history}
+        self._pending.append(record)
+        return record
+    
+    def _append_history(self, entry):
+        return self.history_store.add(entry)
+    
+    def get_rating_history(self, user_id, limit=5, offset=0):
+        """Получить историю изменений рейтинга для пользователя (новые первыми)"""
+        return self.history_store.query('target_id', user_id, offset, limit)
+    
+    def count_rating_history(self, user_id):
+        """Число изменений рейтинга пользователя за всё время"""
+        return self.history_store.count('target_id', user_id)
+    
+    def get_changes_by(self, changer_id, limit=5, offset=0):
+        """Получить изменения рейтинга, сделанные модератором (новые первыми)"""
+        return self.history_store.query('changer_id', changer_id, offset, limit)
+    
+    def count_changes_by(self, changer_id):
+        """Число изменений рейтинга, сделанных модератором за всё время"""
+        return self.history_store.count('changer_id', changer_id)
+    
+    def get_recent_history(self, limit=5, offset=0):
+        """Получить последние изменения рейтинга (новые первыми)"""
+        return self.history_store.query(offset=offset, limit=limit)
+    
+    def count_history(self):
+        """Число записей во всей истории изменений"""
+        return self.history_store.count()
+    
+    def get_window_leaderboard(self, window):
+        # Под блокировкой: сдвиг окна на новый день меняет корзины, которые копирует flush()
+        with self._lock:
+            return self.history_store.windows.leaderboard(window)
+    
+    def get_audit(self, window=None):
+        with self._lock:
+            return self.history_store.audit.period(window)
+    
+    def iter_ratings(self, chunk_size=1000):
+        with self._lock:
+            snapshot = self.leaderboard.snapshot()
+        return self._iter_snapshot(snapshot, chunk_size)
+    
+    def _iter_snapshot(self, snapshot, chunk_size):
+        # Пока версия не изменилась, снимок читает сам индекс - под блокировкой
+        for offset in range(0, len(snapshot), chunk_size):
+            with self._lock:
+                page = snapshot.page(offset, chunk_size)
+            for rank, (user_id, rating) in enumerate(page, offset + 1):
+                yield rank, user_id, rating
+    
+    def iter_history(self, since=None, until=None, user_id=None):
+        with self._lock:
+            return self.history_store.iter_entries(since, until, user_id)
+    
+    def get_rating(self, user_id):
+        return self.data.get(int(user_id), 0)
+    
+    def apply(self, ratings, history):
+        """Применить изменения транзакции и сохранить их разом (всё или ничего)"""
+        if not ratings and not history:
+            return
+        
+        if self.journal:
+            self._apply_journaled(ratings, history)
+            return
+        
+        with self._lock:
+            previous_ratings, records = self._apply_in_memory(ratings, history)
+            record = self._commit(ratings, history)
+        
+        if self.on_dirty is not None:
+            # Фоновая запись: изменения уже в памяти, на диск попадут при flush()
+            self.on_dirty()
+            return
+        
+        try:
+            self.flush()
+        except Exception:
+            # Откатываем изменения в памяти, если их не удалось сохранить
+            with self._lock:
+                self._pending = [r for r in self._pending if r is not record]
+                self._rollback(previous_ratings, records)
+            raise
+    
+    def _apply_journaled(self, ratings, history):
+        """Журнальный режим: изменения подтверждаются записью в журнал сразу,
+        в фон (или в flush() здесь же) уходят только сегменты истории и снимок"""
+        # Записи попадают в журнал в том же порядке, в каком применяются в памяти
+        with self._journal_lock:
+            with self._lock:
+                # Номер первой записи истории: по нему при запуске видно, что уже в сегментах
+                # (время для этого не годится - часы переводятся назад)
+                seq = self.history_store.count()
+                previous_ratings, records = self._apply_in_memory(ratings, history)
+            try:
+                self._write_journal([{'ratings': ratings, 'history': history, 'seq': seq}])
+            except Exception:
+                with self._lock:
+                    self._rollback(previous_ratings, records)
+                raise
+        
+        if self.on_dirty is not None:
+            self.on_dirty()
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            # Изменения уже в журнале; сегменты допишет следующий flush(), а при сбое - запуск
+            print(f"Ошибка записи истории рейтинга: {e}")
+    
+    def _apply_in_memory(self, ratings, history):
+        """Применить изменения в памяти (под self._lock); возвращает то, что нужно для отката"""
+        previous_ratings = {int(user_id): self.data.get(int(user_id)) for user_id in ratings}
+        # Индекс обновляет и self.data (это один словарь)
+        for user_id, rating in ratings.items():
+            self.leaderboard.update(user_id, rating)
+        records = [self._append_history(entry) for entry in history]
+        return previous_ratings, records
+    
+    def _rollback(self, previous_ratings, records):
+        for user_id, rating in previous_ratings.items():
+            if rating is None:
+                self.leaderboard.discard(user_id)
+            else:
+                self.leaderboard.update(user_id, rating)
+        self.history_store.discard(records)
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, islice
+from dotenv import load_dotenv
+from decay import run_decay
+from flusher import BackgroundFlusher
+from metrics import metrics
+from remote_storage import DEFAULT_ADDRESS, encode, parse_address
+from shards import shards_from_env
+
+# Сколько байт читается из сокета за раз; все целые строки из прочитанного - один пакет
+READ_CHUNK = 256 * 1024
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+# Методы RatingDatabase, которые клиент вызывает напрямую
+DIRECT_METHODS = {
+    'get_rating', 'get_ratings', 'get_rating_history', 'count_rating_history', 'get_changes_by',
+    'count_changes_by', 'get_recent_history', 'count_history', 'get_audit'
+}
+
+def plain(value):
+    """Результат в виде, который переживает JSON (записи истории - словарями)"""
+    if isinstance(value, list):
+        return [dict(item) if hasattr(item, 'keys') else item for item in value]
+    return value
+
+class RatingStoreServer:
+    """Общее хранилище рейтинга для нескольких процессов бота.
+
+    Владеет базами серверов (GuildShards) и выполняет запросы клиентов
+    (remote_storage.StoreClient) по одному в единственном рабочем потоке,
+    поэтому записи разных процессов упорядочены и не затирают друг друга.
+    Все запросы, пришедшие от клиента одним чтением из сокета, выполняются
+    одним заходом в рабочий поток, а ответы на них уходят одной записью.
+    На диск базы пишет BackgroundFlusher, как и в самом боте."""
+    def __init__(self, shards):
+        self.shards = shards
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rating-store')
+        self._cursor_ids = count(1)
+        # Соединения клиентов, чтобы закрыть их при остановке
+        self._writers = set()
+    
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self._writers.add(writer)
+        # Открытые выгрузки этого клиента: номер -> итератор
+        cursors = {}
+        buffer = b''
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK)
+                if not data:
+                    break
+                *lines, buffer = (buffer + data).split(b'\n')
+                if not lines:
+                    continue
+                metrics.observe('rating_store_batch_requests', 'requests', len(lines), BATCH_BUCKETS)
+                responses = await loop.run_in_executor(self._executor, self.execute_batch, lines, cursors)
+                writer.write(b''.join(responses))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+    
+    def execute_batch(self, lines, cursors):
+        responses = []
+        for line in lines:
+            request_id = None
+            try:
+                request_id, guild_id, method, args = json.loads(line)
+                with metrics.timer('rating_store_seconds', method):
+                    result = self.execute(guild_id, method, args, cursors)
+                responses.append(encode([request_id, plain(result)]))
+            except Exception as e:
+                responses.append(encode([request_id, None, f"{type(e).__name__}: {e}"]))
+        return responses
+    
+    def execute(self, guild_id, method, args, cursors):
+        if method == 'legacy_guild_id':
+            return self.shards.legacy_guild_id
+        if method == 'set_legacy_guild_id':
+            if self.shards.legacy_guild_id is None:
+                self.shards.legacy_guild_id = args[0]
+            return None
+        if method == 'stored_guilds':
+            return self.shards.stored_guilds()
+        if method == 'next':
+            cursor, limit = args
+            rows = plain(list(islice(cursors[cursor], limit)))
+            if len(rows) < limit:
+                del cursors[cursor]
+            return rows
+        if method == 'close_cursor':
+            cursors.pop(args[0], None)
+            return None
+        
+        db = self.shards.get(guild_id)
+        if method in DIRECT_METHODS:
+            return getattr(db, method)(*args)
+        if method == 'apply':
+            amounts, history, ratings = args
+            with db.transaction() as tx:
+                tx.ratings.update(ratings)
+                for user_id, amount in amounts.items():
+                    tx.add_rating(user_id, amount)
+                tx.history.extend(history)
+            return tx.ratings
+        if method == 'run_decay':
+            return run_decay(db, *args)
+        if method == 'leaderboard':
+            window, operation, *operation_args = args
+            leaderboard = db.leaderboard if window is None else db.get_window_leaderboard(window)
+            if operation == 'version':
+                return leaderboard.version
+            if operation == 'len':
+                return len(leaderboard)
+            if operation in ('page', 'read_page', 'bottom', 'rank'):
+                return getattr(leaderboard, operation)(*operation_args)
+        if method in ('iter_ratings', 'iter_history'):
+            cursor = next(self._cursor_ids)
+            cursors[cursor] = getattr(db, method)(*args)
+            return cursor
+        raise ValueError(f"Неизвестный запрос: {method}")
+    
+    async def start(self, address):
+        family, target = parse_address(address)
+        if family == socket.AF_UNIX:
+            # Сокет, оставшийся от прошлого запуска
+            if os.path.exists(target):
+                os.remove(target)
+            return await asyncio.start_unix_server(self.handle, target)
+        return await asyncio.start_server(self.handle, *target)
+    
+    def disconnect_clients(self):
+        """Закрыть соединения клиентов. Server.wait_closed() (Python 3.12+) ждёт,
+        пока закроются все соединения, а процессы бота сами не отключаются"""
+        for writer in list(self._writers):
+            writer.close()
+    
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+async def serve(address):
+    shards = shards_from_env()
+    flusher = BackgroundFlusher.from_env(shards)
+    store = RatingStoreServer(shards)
+    server = await store.start(address)
+    flusher.start()
+    print(f"Хранилище рейтинга слушает {address}")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        store.disconnect_clients()
+        await server.wait_closed()
+        store.close()
+        await flusher.stop()
+        shards.close()
+
+if __name__ == "__main__":
+    load_dotenv()
+    asyncio.run(serve(os.getenv('RATING_STORE_ADDRESS', DEFAULT_ADDRESS)))
@@ -0,0 +1,107 @@
+from datetime import date, timedelta
+from leaderboard import Leaderboard
+
+# Окна топа: название -> сколько последних дней (включая сегодня) в него входит
+WINDOWS = {'day': 1, 'week': 7, 'month': 30}
+# На этот id пишутся записи истории обо всём сервере (итог затухания рейтинга,
+# см. decay.py); в топы за период они не попадают
+SERVER_USER_ID = 0
+
+class TimeWindows:
+    """Сколько LP набрал каждый пользователь за последние дни.
+
+    Изменения из истории складываются в корзины по дням, а для каждого окна
+    (день, неделя, месяц) поддерживаются суммы и упорядоченный топ (Leaderboard),
+    поэтому страница топа за неделю читается так же быстро, как общий топ.
+    Когда наступает новый день, выпавшие из окна корзины вычитаются из сумм,
+    а корзины старше самого длинного окна удаляются."""
+    def __init__(self, windows=WINDOWS):
+        self.windows = dict(windows)
+        self.days = {}
+        self.totals = {name: {} for name in self.windows}
+        self.leaderboards = {name: Leaderboard() for name in self.windows}
+        self._today = date.today()
+    
+    def _cutoff(self, name, today=None):
+        """Первый день (ГГГГ-ММ-ДД), который входит в окно"""
+        return ((today or self._today) - timedelta(days=self.windows[name] - 1)).isoformat()
+    
+    def first_day(self):
+        """Самый ранний день, который ещё нужен хоть одному окну"""
+        return min(self._cutoff(name) for name in self.windows)
+    
+    def _change(self, name, user_id, amount):
+        totals = self.totals[name]
+        total = totals.get(user_id, 0) + amount
+        if total:
+            totals[user_id] = total
+            self.leaderboards[name].update(user_id, total)
+        else:
+            totals.pop(user_id, None)
+            self.leaderboards[name].discard(user_id)
+    
+    def add(self, entry, sign=1):
+        """Учесть запись истории (sign=-1 - отменить её)"""
+        self.expire()
+        day = entry['timestamp'][:10]
+        if day < self.first_day():
+            return
+        user_id = int(entry['target_id'])
+        if user_id == SERVER_USER_ID:
+            return
+        amount = entry['amount'] * sign
+        bucket = self.days.setdefault(day, {})
+        bucket[user_id] = bucket.get(user_id, 0) + amount
+        if not bucket[user_id]:
+            del bucket[user_id]
+        for name in self.windows:
+            if day >= self._cutoff(name):
+                self._change(name, user_id, amount)
+    
+    def discard(self, entry):
+        self.add(entry, sign=-1)
+    
+    def expire(self):
+        """Сдвинуть окна на сегодняшний день"""
+        today = date.today()
+        if today == self._today:
+            return
+        for name in self.windows:
+            old_cutoff = self._cutoff(name)
+            new_cutoff = self._cutoff(name, today)
+            # Часы могут уйти и назад: тогда сохранившиеся корзины возвращаются в окно
+            low, high, sign = (old_cutoff, new_cutoff, -1) if new_cutoff > old_cutoff else (new_cutoff, old_cutoff, 1)
+            for day, bucket in self.days.items():
+                if low <= day < high:
+                    for user_id, amount in bucket.items():
+                        self._change(name, user_id, sign * amount)
+        self._today = today
+        first_day = self.first_day()
+        for day in [day for day in self.days if day < first_day]:
+            del self.days[day]
+    
+    def leaderboard(self, name):
+        """Топ окна на сегодня (version, len(), page(), snapshot())"""
+        self.expire()
+        return self.leaderboards[name]
+    
+    def snapshot(self):
+        """Корзины по дням для сохранения {ГГГГ-ММ-ДД: {user_id (int): сумма}}"""
+        return {day: dict(bucket) for day, bucket in self.days.items()}
+    
+    def load(self, days):
+        """Восстановить окна из сохранённых корзин"""
+        self._today = date.today()
+        first_day = self.first_day()
+        # В segments.json ключи пользователей - строки
+        self.days = {day: {int(user_id): amount for user_id, amount in bucket.items()}
+                     for day, bucket in days.items() if day >= first_day}
+        for name in self.windows:
+            cutoff = self._cutoff(name)
+            totals = {}
+            for day, bucket in self.days.items():
+                if day >= cutoff:
+                    for user_id, amount in bucket.items():
+                        totals[user_id] = totals.get(user_id, 0) + amount
+            self.totals[name] = {user_id: total for user_id, total in totals.items() if total}
+            self.leaderboards[name].rebuild(self.totals[name])